@@ -2,6 +2,8 @@ import numpy as np
 from traits.api import *
 from traitschema import Schema
 
+_RNG = np.random.default_rng(0xC0FFEE)
+
 
 class FitResults(Schema):
     """Stores results from a fit."""
@@ -32,7 +34,7 @@ def sine(x, omega=1., A=1., phi=0.):
 def generate_data():
     x = np.linspace(-10, 10, 200)
     y = sine(x, 1, 2, np.pi/2.)
-    return x, y + np.random.uniform(-1, 1, len(x))
+    return x, y + _RNG.uniform(-1, 1, len(x))
 
 
 if __name__ == "__main__":
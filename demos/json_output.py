@@ -4,6 +4,8 @@ import numpy as np
 from traits.api import Array, String
 from traitschema import Schema
 
+_RNG = np.random.default_rng(0xC0FFEE)
+
 
 class MatrixSchema(Schema):
     meta = String("default")
@@ -11,10 +13,11 @@ class MatrixSchema(Schema):
 
 
 matrix = MatrixSchema()
-matrix.data = np.random.random((8, 8))
+matrix.data = _RNG.random((8, 8))
 
-with open('out.json', 'w') as jf:
-    jf.write(matrix.to_json(indent=2))
+# Opening in binary mode lets orjson (when installed) write its output directly
+with open('out.json', 'wb') as jf:
+    matrix.to_json({'indent': 2}, fp=jf)
 
 with open('out.json', 'r') as jf:
     print(MatrixSchema.from_json(jf).data)
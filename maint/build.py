@@ -4,6 +4,8 @@ from __future__ import print_function
 
 from argparse import ArgumentParser
 import glob
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import platform
 import os
 import shlex
@@ -20,6 +22,12 @@ parser.add_argument('--no-convert', action='store_true', default=False,
                     help='do not convert packages for other platforms')
 
 
+def run(cmd):
+    """Print and run a command."""
+    print(cmd)
+    check_call(shlex.split(cmd))
+
+
 def clean():
     """Clean the build directory."""
     print("rm -rf build/")
@@ -33,8 +41,7 @@ def clean():
 def build():
     """Build conda packages."""
     build_cmd = "conda build conda.recipe --output-folder build/"
-    print(build_cmd)
-    check_call(shlex.split(build_cmd))
+    run(build_cmd)
 
 
 def convert():
@@ -47,10 +54,19 @@ def convert():
     dirname = '{}-{}'.format(os_name, platform.architecture()[0][:2])
     files = glob.glob('build/{}/*.tar.bz2'.format(dirname))
 
-    for filename in files:
-        convert_cmd = "conda convert {} -p all -o build/".format(filename)
-        print(convert_cmd)
-        check_call(shlex.split(convert_cmd))
+    convert_cmds = ["conda convert {} -p all -o build/".format(filename)
+                    for filename in files]
+    if not convert_cmds:
+        return
+
+    # Each conversion runs in its own subprocess so threads are enough to run
+    # them concurrently
+    pool = ThreadPool(min(len(convert_cmds), cpu_count()))
+    try:
+        pool.map(run, convert_cmds)
+    finally:
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from setuptools import setup
+from setuptools import find_packages, setup
 from traitschema import __version__
 
 with open("README.rst", 'r') as f:
@@ -13,10 +13,7 @@ setup(
     author="Michael V. DePalatis",
     author_email="mike@depalatis.net",
     license="BSD",
-    packages=['traitschema'],
-    package_data={
-        "": ["*.txt", "*.json"]
-    },
+    packages=find_packages(exclude=['tests*', 'demos*', 'maint*']),
     # install_requires=[
     #     "numpy",
     #     "traits",
@@ -1,23 +1,31 @@
 from copy import deepcopy
+import gzip
+import io
 import json
+import os
 import os.path as osp
-import string
-import random
+import zipfile
 
 import h5py
 import numpy as np
 from numpy.testing import assert_equal
 import pytest
 
-from traits.api import Array, CStr, Float, ArrayOrNone
+from traits.api import (
+    Any, Array, ArrayOrNone, BaseInt, CStr, Float, Int, List
+)
 from traitschema import Schema
-from traitschema.io import bundle_schema, load_bundle
+import traitschema.schema
+from traitschema.io import (
+    bundle_schema, load_bundle, UnsupportedArchiveFormat, _get_archive_format
+)
+from traitschema.schema import _auto_chunks, _convert_string_fields
 
 
-def generate_random_string(size=10):
-    mystring = ''.join(random.choice(string.printable)
-                       for _ in range(size))
-    return mystring
+def generate_random_strings(n, size=10):
+    """Generate an array of ``n`` random printable ASCII strings."""
+    chars = np.random.randint(33, 127, size=(n, size), dtype=np.uint8)
+    return chars.view('S{}'.format(size)).astype('<U{}'.format(size)).ravel()
 
 
 @pytest.fixture(scope='session')
@@ -41,9 +49,67 @@ def test_eq():
     b = SomeSchema(x=[3, 2, 3], y=[3, 1, 1], z=None, name='a thing')
     assert a != b
     assert a == deepcopy(a)
+    assert not a != deepcopy(a)
+    assert a != object()
 
+    # Multidimensional arrays
+    c = SomeSchema(x=np.ones((2, 3)), y=np.arange(6).reshape(3, 2))
+    assert c == deepcopy(c)
+    x = np.ones((2, 3))
+    x[1, 2] = 0
+    assert c != SomeSchema(x=x, y=c.y)
 
-@pytest.mark.parametrize('format', ['.npz', '.h5', '.json'])
+    # Arrays which broadcast against each other aren't equal
+    assert SomeSchema(x=[1, 1]) != SomeSchema(x=[1])
+    assert SomeSchema(z=np.zeros(3)) != SomeSchema(z=None)
+
+
+def test_trait_plan():
+    class Child(SomeSchema):
+        extra = Float()
+
+    plan = SomeSchema._trait_plan()
+    assert SomeSchema._trait_plan() is plan
+    assert sorted(name for name, _, _, _ in plan) == ['name', 'x', 'y', 'z']
+    assert ('x', True, np.dtype(np.float64), None) in plan
+
+    assert sorted(SomeSchema._cached_visible_traits()) == ['name', 'x', 'y', 'z']
+    assert dict(SomeSchema._trait_pairs())['x'] is SomeSchema.class_traits()['x']
+
+    child_plan = Child._trait_plan()
+    assert sorted(name for name, _, _, _ in child_plan) == \
+        ['extra', 'name', 'x', 'y', 'z']
+    assert SomeSchema._trait_plan() is plan
+
+
+def test_add_class_trait():
+    class Parent(Schema):
+        a = Int()
+
+    class Child(Parent):
+        pass
+
+    assert Parent._cached_visible_traits() == ('a',)
+    assert Child(a=1).to_dict() == {'a': 1}
+
+    Parent.add_class_trait('b', Int())
+    assert sorted(Parent._cached_visible_traits()) == ['a', 'b']
+    assert Child(a=1, b=2).to_dict() == {'a': 1, 'b': 2}
+    assert Child(a=1, b=2) != Child(a=1, b=3)
+
+
+def test_keyword_trait_names():
+    class KeywordSchema(Schema):
+        a = Int()
+
+    KeywordSchema.add_class_trait('lambda', Int())
+    obj = KeywordSchema(a=1, **{'lambda': 2})
+    assert obj.to_dict() == {'a': 1, 'lambda': 2}
+    assert obj == KeywordSchema(a=1, **{'lambda': 2})
+    assert obj != KeywordSchema(a=1, **{'lambda': 3})
+
+
+@pytest.mark.parametrize('format', ['.npz', '.h5', '.json', '.H5'])
 def test_save_load(format, tmpdir):
     x = np.random.random(100)
     y = np.linspace(0, 100, 100, dtype=np.int)
@@ -62,6 +128,56 @@ def test_save_load(format, tmpdir):
     assert loaded.name == name
 
 
+@pytest.mark.parametrize('format', ['npz', 'h5', 'json'])
+def test_load_from_fileobj(format, tmpdir):
+    schema = SomeSchema(x=np.random.random(10), y=np.arange(5), name='obj')
+    outfile = str(tmpdir.join('filename.' + format))
+    schema.save(outfile)
+
+    with open(outfile, 'rb') as f:
+        loaded = SomeSchema.load_from_fileobj(io.BytesIO(f.read()), format)
+    assert loaded == schema
+
+
+@pytest.mark.parametrize('format', ['npz', 'h5', 'json'])
+def test_to_bytes(format):
+    schema = SomeSchema(x=np.random.random(10), y=np.arange(5), name='obj')
+    data = schema.to_bytes(format)
+    assert isinstance(data, bytes)
+
+    loaded = SomeSchema.load_from_fileobj(io.BytesIO(data), format)
+    assert loaded == schema
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_npy_dir(mmap, tmpdir, sample_recarray):
+    class NpySchema(SomeSchema):
+        count = Int()
+        values = List(Int())
+
+    obj = NpySchema(x=np.random.random((10, 3)), y=sample_recarray,
+                    name='terry', count=3, values=[1, 2, 3])
+    dirname = str(tmpdir.join('schema'))
+    obj.to_npy_dir(dirname)
+
+    assert sorted(os.listdir(dirname)) == \
+        ['count.npy', 'index.json', 'name.npy', 'values.npy', 'x.npy',
+         'y.npy']
+
+    loaded = NpySchema.from_npy_dir(dirname, mmap=mmap)
+    assert isinstance(loaded.x, np.memmap) == mmap
+    assert_equal(loaded.x, obj.x)
+    assert_equal(loaded.y, obj.y)
+    assert loaded.z is None
+    assert loaded.name == 'terry'
+    assert loaded.count == 3
+    assert loaded.values == [1, 2, 3]
+
+    with pytest.raises(ValueError):
+        AnySchema(value={'a': 1}).to_npy_dir(str(tmpdir.join('pickled')))
+    assert not tmpdir.join('pickled').exists()
+
+
 @pytest.mark.parametrize('mode', ['w', 'a'])
 @pytest.mark.parametrize('desc', ['a number', None])
 @pytest.mark.parametrize('compression', [None, 'gzip', 'lzf'])
@@ -81,8 +197,7 @@ def test_to_hdf(mode, desc, compression, compression_opts, encoding, tmpdir,
                    w=0.01,
                    x=np.random.random(100),
                    y=np.random.random(100),
-                   z=np.array([generate_random_string() for _ in range(100)],
-                              dtype=np.unicode))
+                   z=generate_random_strings(100))
 
     filename = str(tmpdir.join('test.h5'))
 
@@ -99,7 +214,7 @@ def test_to_hdf(mode, desc, compression, compression_opts, encoding, tmpdir,
         call()
 
     with h5py.File(filename, 'r') as hfile:
-        assert_equal(hfile['/w'].value, obj.w)
+        assert_equal(hfile['/w'][()], obj.w)
         assert_equal(hfile['/x'][:], obj.x)
         assert_equal(hfile['/y'][:], obj.y)
         assert_equal([s.decode('utf8') for s in hfile['/z'][:]], obj.z)
@@ -112,12 +227,312 @@ def test_to_hdf(mode, desc, compression, compression_opts, encoding, tmpdir,
             assert hfile['/y'].attrs['desc'] == desc
             assert hfile['/z'].attrs['desc'] == desc
         else:
-            # 'type' attribute should be populated
-            assert 'type' in hfile['/v'].attrs.keys()
-            assert 'type' in hfile['/w'].attrs.keys()
-            assert 'type' in hfile['/x'].attrs.keys()
-            assert 'type' in hfile['/y'].attrs.keys()
-            assert 'type' in hfile['/z'].attrs.keys()
+            # No attributes should be written
+            for name in 'vwxyz':
+                assert len(hfile['/' + name].attrs) == 0
+
+
+@pytest.mark.parametrize('compression', [True, 'auto', False])
+def test_to_hdf_auto_compression(compression, tmpdir):
+    try:
+        import hdf5plugin
+    except ImportError:
+        hdf5plugin = None
+
+    obj = SomeSchema(x=np.random.random(1000), y=np.arange(100), name='auto')
+    filename = str(tmpdir.join('auto.h5'))
+    obj.to_hdf(filename, compression=compression, compression_opts=3)
+
+    with h5py.File(filename, 'r') as hfile:
+        dset = hfile['/x']
+        if not compression:
+            assert dset.compression is None
+            assert not dset.shuffle
+        elif hdf5plugin is None:
+            assert dset.compression == 'lzf'
+            assert dset.shuffle
+        else:
+            assert '32001' in dset._filters
+
+    assert_equal(SomeSchema.from_hdf(filename).x, obj.x)
+
+
+@pytest.mark.parametrize('compression_opts', [None, 9])
+def test_to_hdf_blosc(compression_opts, tmpdir):
+    pytest.importorskip('hdf5plugin')
+
+    obj = SomeSchema(x=np.random.random(1000), y=np.arange(100), name='blosc')
+    filename = str(tmpdir.join('blosc.h5'))
+    obj.to_hdf(filename, compression='blosc',
+               compression_opts=compression_opts)
+
+    with h5py.File(filename, 'r') as hfile:
+        assert '32001' in hfile['/x']._filters
+
+    loaded = SomeSchema.from_hdf(filename)
+    assert_equal(loaded.x, obj.x)
+    assert_equal(loaded.y, obj.y)
+
+
+@pytest.mark.parametrize('compression_opts', [None, 9])
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_to_hdf_max_workers(max_workers, compression_opts, tmpdir):
+    class BigSchema(Schema):
+        x = Array(dtype=np.float64)
+        y = Array(dtype=np.int16)
+
+    obj = BigSchema(x=np.random.random((701, 499)),
+                    y=np.arange(1 << 20, dtype=np.int16))
+    filename = str(tmpdir.join('big.h5'))
+    obj.to_hdf(filename, compression='gzip',
+               compression_opts=compression_opts, max_workers=max_workers)
+
+    with h5py.File(filename, 'r') as hfile:
+        assert hfile['/x'].chunks != hfile['/x'].shape
+        assert hfile['/x'].compression == 'gzip'
+        assert_equal(hfile['/x'][:], obj.x)
+        assert_equal(hfile['/y'][:], obj.y)
+
+
+@pytest.mark.parametrize('pack', [False, True])
+def test_to_hdf_direct_chunk(pack, tmpdir):
+    # Large enough to be split into several chunks, including partial ones
+    x = np.random.random((301, 1001))
+    y = np.arange(10, dtype='>i4')
+    obj = SomeSchema(x=x, y=y, z=np.array([u'a', u'b']), name='terry')
+    path = str(tmpdir.join('out.h5'))
+    obj.to_hdf(path, direct_chunk=True, pack=pack)
+
+    if not pack:
+        with h5py.File(path, 'r') as hfile:
+            assert len(hfile['/x'].chunks) == 2
+            assert hfile['/x'].chunks != hfile['/x'].shape
+            assert hfile['/y'].dtype == y.dtype
+
+    loaded = SomeSchema.from_hdf(path)
+    assert_equal(loaded.x, x)
+    assert_equal(loaded.y, y)
+    assert_equal(loaded.z, obj.z)
+
+
+@pytest.mark.parametrize('libver', [None, 'latest'])
+def test_to_hdf_libver(libver, tmpdir):
+    obj = SomeSchema(x=np.random.random(100), y=np.arange(10), name='terry')
+    path = str(tmpdir.join('out.h5'))
+    obj.to_hdf(path, libver=libver)
+
+    with h5py.File(path, 'r') as hfile:
+        low = hfile.libver[0]
+    if libver is None:
+        assert low == 'earliest'
+    else:
+        assert low != 'earliest'
+
+    assert SomeSchema.from_hdf(path) == obj
+
+
+@pytest.mark.parametrize('pack', [False, True])
+@pytest.mark.parametrize('scalars_as_attrs', [False, True])
+def test_from_hdf_lazy(pack, scalars_as_attrs, tmpdir):
+    obj = SomeSchema(x=np.random.random(100), y=np.arange(10), name='terry')
+    path = str(tmpdir.join('out.h5'))
+    obj.to_hdf(path, pack=pack, scalars_as_attrs=scalars_as_attrs)
+
+    with SomeSchema.from_hdf_lazy(path) as lazy:
+        assert_equal(lazy.x, obj.x)
+        assert lazy.name == obj.name
+        assert lazy._loaded == {'x', 'name'}
+        assert lazy.z is None
+        with pytest.raises(AttributeError):
+            lazy.bogus
+
+    with pytest.raises(ValueError):
+        lazy.y
+
+    lazy = SomeSchema.from_hdf_lazy(path)
+    loaded = lazy.load()
+    assert isinstance(loaded, SomeSchema)
+    assert loaded == obj
+    assert lazy._hfile is None
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_hdf_pack(compression, tmpdir):
+    class PackedSchema(Schema):
+        a = Array(dtype=np.float64)
+        b = Array(dtype=np.float64)
+        c = Array(dtype=np.int32)
+        d = Array()
+        e = Float()
+
+    obj = PackedSchema(a=np.random.random((3, 4)),
+                       b=np.random.random(10),
+                       c=np.arange(5, dtype=np.int32),
+                       d=np.array(['a', 'b']),
+                       e=1.5)
+    filename = str(tmpdir.join('packed.h5'))
+    obj.to_hdf(filename, compression=compression, pack=True)
+
+    with h5py.File(filename, 'r') as hfile:
+        assert 'a' not in hfile
+        assert 'c' not in hfile
+        assert_equal(hfile['/packed_float64'].shape, (22,))
+        assert_equal(hfile['/packed_int32'].shape, (5,))
+        assert 'd' in hfile
+
+    loaded = PackedSchema.from_hdf(filename)
+    for name in ['a', 'b', 'c', 'd', 'e']:
+        assert_equal(getattr(loaded, name), getattr(obj, name))
+
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'latin1'])
+def test_hdf_non_ascii_strings(encoding, tmpdir):
+    y = np.array([[u'caf\xe9', u'na\xefve'], [u'\xfcber', u'plain']])
+    obj = SomeSchema(y=y)
+    path = str(tmpdir.join('out.h5'))
+    obj.to_hdf(path, encoding=encoding)
+
+    with h5py.File(path, 'r') as hfile:
+        stored = hfile['/y'][()]
+    assert stored.dtype.kind == 'S'
+    assert stored.shape == (2, 2)
+    assert stored[0, 0] == u'caf\xe9'.encode(encoding)
+
+    loaded = SomeSchema.from_hdf(path, encoding=encoding)
+    assert_equal(loaded.y, y)
+
+
+def test_hdf_recarray_non_ascii(tmpdir):
+    rec = np.rec.fromrecords([(u'caf\xe9', 1.5, 1), (u'x' * 300, 2.5, 2)],
+                             names='s,f,i')
+    obj = SomeSchema(y=rec)
+    path = str(tmpdir.join('out.h5'))
+    obj.to_hdf(path, encoding='utf-8')
+
+    loaded = SomeSchema.from_hdf(path, encoding='utf-8')
+    assert_equal(loaded.y['s'], rec['s'])
+    assert_equal(loaded.y['f'], rec['f'])
+    assert loaded.y.dtype['f'] == rec.dtype['f']
+    assert loaded.y.dtype['i'] == rec.dtype['i']
+
+
+def test_hdf_recarray_with_unicode(tmpdir, sample_recarray):
+    obj = SomeSchema(y=sample_recarray, z=np.array([u'one', u'two']))
+    path = str(tmpdir.join('out.h5'))
+    obj.to_hdf(path)
+
+    with h5py.File(path, 'r') as hfile:
+        assert hfile['/y'].dtype['field_1'].kind == 'S'
+        assert hfile['/z'].dtype.kind == 'S'
+
+    loaded = SomeSchema.from_hdf(path)
+    assert loaded.y.dtype['field_1'].kind == 'U'
+    assert_equal(loaded.y['field_1'], sample_recarray['field_1'])
+    assert_equal(loaded.y['field_2'], sample_recarray['field_2'])
+    assert_equal(loaded.z, obj.z)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_to_hdf_soa(compression, tmpdir, sample_recarray):
+    obj = SomeSchema(x=np.random.random(10), y=sample_recarray, name='soa')
+    path = str(tmpdir.join('soa.h5'))
+    obj.to_hdf(path, soa=True, compression=compression)
+
+    with h5py.File(path, 'r') as hfile:
+        group = hfile['/y']
+        assert isinstance(group, h5py.Group)
+        assert json.loads(group.attrs['fields']) == ['field_1', 'field_2']
+        assert group['field_1'].dtype.kind == 'S'
+        assert_equal(group['field_2'][()], sample_recarray['field_2'])
+
+    for loaded in (SomeSchema.from_hdf(path),
+                   SomeSchema.from_hdf_lazy(path).load()):
+        assert loaded.y.dtype.names == sample_recarray.dtype.names
+        assert loaded.y.dtype['field_1'].kind == 'U'
+        assert_equal(loaded.y['field_1'], sample_recarray['field_1'])
+        assert_equal(loaded.y['field_2'], sample_recarray['field_2'])
+        assert_equal(loaded.x, obj.x)
+
+
+def test_convert_string_fields(sample_recarray):
+    numeric = np.rec.fromrecords([(1, 1.5), (2, 2.5)], names='i,f')
+    assert _convert_string_fields(numeric, 'U', np.char.encode, 'S') is numeric
+
+    encoded = _convert_string_fields(sample_recarray, 'U', np.char.encode, 'S')
+    assert isinstance(encoded, np.recarray)
+    assert encoded.dtype['field_1'] == np.dtype('S256')
+    assert_equal(encoded['field_2'], sample_recarray['field_2'])
+
+
+def test_to_hdf_non_contiguous(tmpdir, sample_recarray):
+    class ViewSchema(Schema):
+        x = Array(dtype=np.float64)
+        y = Array()
+
+    base = np.random.random((10, 10))
+    obj = ViewSchema(x=base[:, ::2].T, y=sample_recarray[::-1])
+    assert not obj.x.flags.c_contiguous
+
+    filename = str(tmpdir.join('views.h5'))
+    obj.to_hdf(filename)
+
+    loaded = ViewSchema.from_hdf(filename)
+    assert_equal(loaded.x, obj.x)
+    assert_equal(loaded.y, obj.y)
+
+
+def test_hdf_scalars_as_attrs(tmpdir):
+    class ScalarSchema(Schema):
+        a = Float(desc='a float')
+        b = Int()
+        c = CStr()
+        classname = CStr()
+        x = Array(dtype=np.float64)
+
+    obj = ScalarSchema(a=1.5, b=3, c='text', classname='reserved',
+                       x=np.random.random(10))
+    filename = str(tmpdir.join('scalars.h5'))
+    obj.to_hdf(filename, scalars_as_attrs=True)
+
+    with h5py.File(filename, 'r') as hfile:
+        for name in ['a', 'b', 'c']:
+            assert name not in hfile
+        assert hfile.attrs['a__desc'] == 'a float'
+        assert 'classname' in hfile
+        assert 'x' in hfile
+
+    loaded = ScalarSchema.from_hdf(filename)
+    assert loaded == obj
+
+
+@pytest.mark.parametrize('shape,itemsize,expected', [
+    ((), 8, None),
+    ((100,), 8, (100,)),
+    ((0,), 8, None),
+    ((10, 0), 8, None),
+    ((1 << 20,), 8, (1 << 17,)),
+    ((1024, 1024), 4, (512, 512)),
+])
+def test_auto_chunks(shape, itemsize, expected):
+    chunks = _auto_chunks(shape, itemsize)
+    assert chunks == expected
+    if chunks is not None:
+        assert np.prod(chunks) * itemsize <= 1 << 20
+
+
+@pytest.mark.parametrize('chunk_size', [1 << 12, 1 << 18])
+def test_to_hdf_chunk_size(chunk_size, tmpdir):
+    obj = SomeSchema(x=np.random.random((100, 1000)), y=np.arange(10))
+    path = str(tmpdir.join('out.h5'))
+    obj.to_hdf(path, chunk_size=chunk_size)
+
+    with h5py.File(path, 'r') as hfile:
+        chunks = hfile['/x'].chunks
+        assert np.prod(chunks) * 8 <= chunk_size
+        assert np.prod(chunks) * 8 > chunk_size // 4
+        assert hfile['/y'].chunks == (10,)
+
+    assert_equal(SomeSchema.from_hdf(path).x, obj.x)
 
 
 @pytest.mark.parametrize("encoding", ['utf-8'])
@@ -127,19 +542,15 @@ def test_from_hdf(tmpdir, encoding, decode_string_arrays, sample_recarray):
     w = w.astype(dtype=[('field_1', '<S256'), ('field_2', '<i8')])
     x = np.arange(10)
     y = np.arange(10, dtype=np.int32)
-    z = np.array([generate_random_string().encode('utf-8') for _ in range(5)])
+    z = np.char.encode(generate_random_strings(5), 'utf-8')
 
     path = str(tmpdir.join('test.h5'))
 
     with h5py.File(path, 'w') as hfile:
-        dset_w = hfile.create_dataset('/w', data=w)
-        dset_w.attrs['type'] = str(np.recarray)
-        dset_x = hfile.create_dataset('/x', data=x, chunks=True)
-        dset_x.attrs['type'] = str(type(x))
-        dset_y = hfile.create_dataset('/y', data=y, chunks=True)
-        dset_y.attrs['type'] = str(type(y))
-        dset_z = hfile.create_dataset('/z', data=z, chunks=True)
-        dset_z.attrs['type'] = str(type(z))
+        hfile.create_dataset('/w', data=w)
+        hfile.create_dataset('/x', data=x, chunks=True)
+        hfile.create_dataset('/y', data=y, chunks=True)
+        hfile.create_dataset('/z', data=z, chunks=True)
 
     class MySchema(Schema):
         w = Array()
@@ -153,12 +564,21 @@ def test_from_hdf(tmpdir, encoding, decode_string_arrays, sample_recarray):
 
     assert_equal(instance.x, x)
     assert_equal(instance.y, y)
+    assert instance.x.dtype == np.float64
+    assert instance.y.dtype == np.int32
 
     if decode_string_arrays:
         assert_equal(instance.z, [s.decode(encoding) for s in z])
     else:
         assert_equal(instance.z, z)
 
+    if decode_string_arrays:
+        assert instance.w.dtype['field_1'].kind == 'U'
+        assert_equal(instance.w['field_1'],
+                     np.char.decode(w['field_1'], encoding))
+    else:
+        assert_equal(instance.w, w)
+
 
 def test_to_dict(sample_recarray):
     obj = SomeSchema()
@@ -172,6 +592,15 @@ def test_to_dict(sample_recarray):
     assert_equal(obj.y, d['y'])
 
 
+def test_to_dict_subclass():
+    class Child(SomeSchema):
+        extra = Float(1.0)
+
+    assert sorted(SomeSchema().to_dict()) == ['name', 'x', 'y', 'z']
+    assert sorted(Child().to_dict()) == ['extra', 'name', 'x', 'y', 'z']
+    assert Child().to_dict()['extra'] == 1.0
+
+
 @pytest.mark.parametrize('compress', [True, False])
 def test_to_npz(compress, tmpdir, sample_recarray):
     obj = SomeSchema(name='test',
@@ -185,18 +614,58 @@ def test_to_npz(compress, tmpdir, sample_recarray):
     assert str(npz['name']) == 'test'
     assert_equal([1, 2, 3], npz['x'])
     assert_equal(sample_recarray, npz['y'])
+    assert 'z' not in npz.files
 
 
-def test_from_npz(tmpdir, sample_recarray):
+@pytest.mark.parametrize('mmap_mode', [None, 'r', 'c'])
+@pytest.mark.parametrize('compress', [True, False])
+def test_from_npz(compress, mmap_mode, tmpdir, sample_recarray):
     path = str(tmpdir.join('output.npz'))
-    np.savez(path, x=[1, 2, 3], name='test', y=sample_recarray)
+    save = np.savez_compressed if compress else np.savez
+    save(path, x=[1, 2, 3], name='test', y=sample_recarray)
 
-    obj = SomeSchema.from_npz(path)
+    obj = SomeSchema.from_npz(path, mmap_mode=mmap_mode)
     assert obj.name == 'test'
     assert_equal([1, 2, 3], obj.x)
     assert_equal(sample_recarray, obj.y)
 
 
+@pytest.mark.parametrize('mmap_mode', ['r+', 'w+', 'readwrite'])
+def test_from_npz_writable_mmap_mode(mmap_mode, tmpdir):
+    path = str(tmpdir.join('output.npz'))
+    np.savez(path, x=np.arange(100.))
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    with pytest.raises(ValueError):
+        SomeSchema.from_npz(path, mmap_mode=mmap_mode)
+
+    with open(path, 'rb') as f:
+        assert f.read() == contents
+
+
+def test_init_validates_once():
+    validated = []
+
+    class CountedInt(BaseInt):
+        def validate(self, obj, name, value):
+            validated.append(name)
+            return super(CountedInt, self).validate(obj, name, value)
+
+    class CountingSchema(Schema):
+        value = CountedInt()
+
+    obj = CountingSchema(value=3)
+    assert obj.value == 3
+    assert validated == ['value']
+
+
+def test_init_unknown_trait():
+    with pytest.raises(RuntimeError) as excinfo:
+        SomeSchema(x=np.arange(3), bogus=1, also_bogus=2)
+    assert 'also_bogus, bogus' in str(excinfo.value)
+
+
 def test_to_json(sample_recarray):
     obj_with_recarray = SomeSchema(x=list(range(10)), name="whatever",
                                    y=sample_recarray,
@@ -212,7 +681,168 @@ def test_to_json(sample_recarray):
     assert loaded['name'] == obj.name
 
 
-@pytest.mark.parametrize('fromfile', [True, False])
+@pytest.mark.parametrize('json_kwargs', [{}, {'indent': 2}, {'indent': 4}])
+def test_to_json_kwargs(json_kwargs):
+    obj = SomeSchema(x=np.random.random(10), name="whatever")
+    jobj = obj.to_json(json_kwargs)
+
+    loaded = json.loads(jobj)
+    assert_equal(loaded['x'], obj.x)
+    assert loaded['name'] == obj.name
+
+
+@pytest.mark.parametrize('json_kwargs', [{}, {'indent': 4}])
+def test_to_json_as_bytes(json_kwargs):
+    obj = SomeSchema(x=np.random.random(10), name="whatever")
+    encoded = obj.to_json(json_kwargs, as_bytes=True)
+    assert isinstance(encoded, bytes)
+    assert encoded.decode('utf-8') == obj.to_json(json_kwargs)
+
+
+@pytest.mark.parametrize('mode', ['w', 'wb'])
+@pytest.mark.parametrize('json_kwargs', [{}, {'indent': 4}])
+def test_to_json_fp(mode, json_kwargs, tmpdir):
+    obj = SomeSchema(x=np.random.random(10), name="whatever")
+    filename = str(tmpdir.join('test.json'))
+    with open(filename, mode) as f:
+        assert obj.to_json(json_kwargs, fp=f) is None
+
+    with open(filename, 'r') as f:
+        assert f.read() == obj.to_json(json_kwargs)
+
+
+def test_to_json_unsupported_arrays():
+    class ArraySchema(Schema):
+        a = Array()
+        b = Array()
+
+    base = np.random.random((4, 4))
+    obj = ArraySchema(a=base[:, ::2], b=np.array(['one', 'two']))
+    loaded = json.loads(obj.to_json())
+    assert_equal(loaded['a'], obj.a)
+    assert loaded['b'] == ['one', 'two']
+
+
+def test_to_json_byte_order():
+    class ArraySchema(Schema):
+        a = Array()
+        b = Array()
+
+    obj = ArraySchema(a=np.arange(4, dtype='>f8'),
+                      b=np.arange(6, dtype='>i4').reshape(2, 3).T)
+    loaded = json.loads(obj.to_json())
+    assert loaded == {'a': [0, 1, 2, 3], 'b': [[0, 3], [1, 4], [2, 5]]}
+
+    tagged = ArraySchema.from_json(obj.to_json(tag_arrays=True))
+    assert tagged.a.dtype == obj.a.dtype
+    assert_equal(tagged.a, obj.a)
+    assert_equal(tagged.b, obj.b)
+
+    class NestedSchema(Schema):
+        c = Any()
+
+    nested = NestedSchema(c={'a': np.arange(3, dtype='>f8'),
+                             'b': [np.arange(2, dtype='>i2')]})
+    for tag_arrays in (False, True):
+        loaded = json.loads(nested.to_json(tag_arrays=tag_arrays))
+        assert loaded == {'c': {'a': [0, 1, 2], 'b': [[0, 1]]}}
+
+
+def test_json_tag_arrays():
+    class TaggedSchema(Schema):
+        a = Array()
+        b = Array()
+        c = Array()
+        d = Any()
+
+    obj = TaggedSchema(a=np.arange(6, dtype='<u2').reshape(2, 3),
+                       b=np.random.random((3, 4)).T,
+                       c=np.array([u'x', u'yz']), d=1)
+    encoded = obj.to_json(tag_arrays=True)
+
+    raw = json.loads(encoded)
+    assert raw['a'] == {'__ndarray__': True, 'dtype': '<u2', 'shape': [2, 3],
+                        'data': [0, 1, 2, 3, 4, 5]}
+    assert raw['d'] == 1
+
+    loaded = TaggedSchema.from_json(encoded)
+    for name in 'abc':
+        assert getattr(loaded, name).dtype == getattr(obj, name).dtype
+        assert_equal(getattr(loaded, name), getattr(obj, name))
+
+
+def test_to_json_non_str_keys():
+    class DictSchema(Schema):
+        mapping = Any()
+
+    obj = DictSchema(mapping={1: 'one', 'two': 2})
+    assert json.loads(obj.to_json()) == {'mapping': {'1': 'one', 'two': 2}}
+
+
+def test_to_json_numpy_scalars():
+    class ScalarSchema(Schema):
+        a = Any()
+        b = Any()
+
+    obj = ScalarSchema(a=np.int64(3), b=np.float32(0.5))
+    loaded = json.loads(obj.to_json())
+    assert loaded == {'a': 3, 'b': 0.5}
+
+
+@pytest.mark.parametrize('mode', ['w', 'wb'])
+def test_to_json_file(mode, tmpdir, sample_recarray):
+    obj = SomeSchema(x=np.random.random(10), y=np.arange(3), name=u'caf\xe9')
+    path = str(tmpdir.join('out.json'))
+    with io.open(path, mode, **({'encoding': 'utf-8'} if mode == 'w' else {})) as f:
+        obj.to_json_file(f)
+
+    with io.open(path, 'r', encoding='utf-8') as f:
+        assert json.load(f) == json.loads(obj.to_json())
+    with io.open(path, 'rb') as f:
+        assert SomeSchema.from_json(f) == obj
+
+    # Nothing is written when a recarray can't be encoded
+    out = io.BytesIO()
+    with pytest.raises(RuntimeError):
+        SomeSchema(x=np.arange(3.), y=sample_recarray, name='rec')\
+            .to_json_file(out)
+    assert out.getvalue() == b''
+
+
+@pytest.mark.parametrize('mode', ['', 'b'])
+def test_json_stream(mode, tmpdir):
+    obj = SomeSchema(x=np.random.random(10), y=np.arange(3), name="whatever")
+    filename = str(tmpdir.join('test.ndjson'))
+    with open(filename, 'w' + mode) as f:
+        obj.to_json_stream(f)
+
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 4
+    assert sorted(json.loads(line)['name'] for line in lines) == \
+        ['name', 'x', 'y', 'z']
+
+    with open(filename, 'r' + mode) as f:
+        loaded = SomeSchema.from_json_stream(f)
+    assert loaded == obj
+
+
+def test_json_stream_errors(sample_recarray):
+    # Unknown traits are rejected like in the constructor
+    stream = io.StringIO(u'{"name": "x", "value": [1.0]}\n'
+                         u'{"name": "unknown", "value": 1}\n')
+    with pytest.raises(RuntimeError):
+        SomeSchema.from_json_stream(stream)
+
+    # Nothing is written when a recarray can't be encoded
+    obj = SomeSchema(x=np.arange(3.), y=sample_recarray)
+    out = io.StringIO()
+    with pytest.raises(RuntimeError):
+        obj.to_json_stream(out)
+    assert out.getvalue() == ''
+
+
+@pytest.mark.parametrize('fromfile', [True, False, 'rb'])
 def test_from_json(fromfile, tmpdir):
     data = {
         "x": list(range(10)),
@@ -226,14 +856,57 @@ def test_from_json(fromfile, tmpdir):
         with open(filename, 'w') as f:
             json.dump(data, f)
 
-        with open(filename, 'r') as f:
+        with open(filename, 'rb' if fromfile == 'rb' else 'r') as f:
             obj = SomeSchema.from_json(f)
 
     assert_equal(obj.x, data['x'])
     assert obj.name == data['name']
 
 
-@pytest.mark.parametrize('format', ['npz', 'h5', 'json'])
+@pytest.mark.parametrize('backend', ['orjson', 'json'])
+def test_from_json_sources(backend, monkeypatch):
+    monkeypatch.setattr(traitschema.schema, '_JSON_BACKEND', backend)
+    obj = SomeSchema(x=np.arange(3.), name='piped')
+    encoded = obj.to_json()
+
+    assert SomeSchema.from_json(encoded.encode('utf-8')) == obj
+
+    # Pipes can't seek
+    read_fd, write_fd = os.pipe()
+    with io.open(write_fd, 'w', encoding='utf-8') as f:
+        f.write(encoded)
+    with io.open(read_fd, 'r', encoding='utf-8') as f:
+        assert not f.seekable()
+        assert SomeSchema.from_json(f) == obj
+
+
+def test_json_non_finite():
+    class NonFiniteSchema(Schema):
+        a = Float()
+        b = Array()
+        c = Any()
+
+    obj = NonFiniteSchema(a=float('nan'), b=np.array([1., np.inf, -np.inf]),
+                      c={'d': [1.5, float('nan')]})
+    encoded = obj.to_json()
+    assert 'NaN' in encoded and 'Infinity' in encoded
+
+    loaded = NonFiniteSchema.from_json(encoded)
+    assert np.isnan(loaded.a)
+    assert_equal(loaded.b, obj.b)
+    assert loaded.c['d'][0] == 1.5
+    assert np.isnan(loaded.c['d'][1])
+
+    # Files written by the standard library can be read
+    loaded = NonFiniteSchema.from_json(json.dumps({'a': float('inf')}))
+    assert loaded.a == float('inf')
+
+
+class AnySchema(Schema):
+    value = Any()
+
+
+@pytest.mark.parametrize('format', ['npz', 'h5', 'json', 'raw'])
 @pytest.mark.parametrize('archive_format', ['.zip'])
 def test_bundle(format, archive_format, tmpdir):
     """Tests saving and loading of bundles. If the format changes, the saving
@@ -253,8 +926,153 @@ def test_bundle(format, archive_format, tmpdir):
     path = str(tmpdir.join('out')) + archive_format
     bundle_schema(path, schema, format)
 
+    # No staging files are left behind
+    assert tmpdir.listdir() == [tmpdir.join('out' + archive_format)]
+
     loaded = load_bundle(path)
     assert loaded['first'] == schema['first']
     assert loaded['second'] == schema['second']
     assert '__meta__' in loaded
     assert 'bundle_version' in loaded['__meta__']
+
+    with open(path, 'rb') as f:
+        assert load_bundle(f)['first'] == schema['first']
+
+    # A failed bundle leaves the existing one intact
+    with pytest.raises(TypeError):
+        bundle_schema(path, {'bad': AnySchema(value=object())}, 'raw')
+    assert tmpdir.listdir() == [tmpdir.join('out' + archive_format)]
+    assert load_bundle(path)['first'] == schema['first']
+
+
+@pytest.mark.parametrize('format', ['npz', 'raw'])
+def test_load_bundle_keys(format, tmpdir):
+    schema = {
+        key: SomeSchema(x=np.random.random(10), name=key)
+        for key in ['a', 'b', 'c']
+    }
+    path = str(tmpdir.join('out.zip'))
+    bundle_schema(path, schema, format)
+
+    loaded = load_bundle(path, keys=['c', 'a'])
+    assert list(loaded) == ['__meta__', 'a', 'c']
+    assert loaded['a'] == schema['a']
+    assert loaded['c'] == schema['c']
+
+    with pytest.raises(KeyError):
+        load_bundle(path, keys=['a', 'd'])
+
+    with pytest.raises(TypeError):
+        load_bundle(path, keys='a')
+
+
+def test_get_archive_format(tmpdir):
+    obj = SomeSchema(x=np.arange(3.), name='terry')
+
+    # Detected by content regardless of extension
+    path = str(tmpdir.join('out.zip'))
+    bundle_schema(path, {'a': obj})
+    renamed = str(tmpdir.join('out.backup'))
+    os.rename(path, renamed)
+    assert _get_archive_format(renamed) == 'zip'
+    assert load_bundle(renamed)['a'] == obj
+
+    gzipped = str(tmpdir.join('out.zip'))
+    with gzip.open(gzipped, 'wb') as f:
+        f.write(b'not a zip')
+    assert _get_archive_format(gzipped) == 'gztar'
+    with pytest.raises(UnsupportedArchiveFormat):
+        load_bundle(gzipped)
+
+    # Paths which don't exist yet fall back to the extension
+    assert _get_archive_format(str(tmpdir.join('new.ZIP'))) == 'zip'
+    assert _get_archive_format(str(tmpdir.join('new.tar.gz'))) == 'gztar'
+    assert _get_archive_format(str(tmpdir.join('new.txt'))) is None
+    with pytest.raises(UnsupportedArchiveFormat):
+        bundle_schema(str(tmpdir.join('out.tar')), {'a': obj})
+
+
+def test_bundle_member_names(tmpdir):
+    obj = SomeSchema(x=np.arange(3.), name='terry')
+    path = str(tmpdir.join('out.zip'))
+    bundle_schema(path, {'a/b c': obj, u'd\xe9': obj}, 'json')
+
+    with zipfile.ZipFile(path) as zf:
+        names = set(zf.namelist())
+    assert names == {'schema/a%2Fb%20c.json', 'schema/d%C3%A9.json',
+                     'index.json'}
+
+    loaded = load_bundle(path)
+    assert loaded['a/b c'] == obj
+    assert loaded[u'd\xe9'] == obj
+
+
+@pytest.mark.parametrize('format', ['npz', 'h5', 'json', 'raw'])
+def test_bundle_index_key(format, tmpdir):
+    obj = SomeSchema(x=np.arange(3.), name='terry')
+    path = str(tmpdir.join('out.zip'))
+    bundle_schema(path, {'index': obj}, format)
+
+    with zipfile.ZipFile(path) as zf:
+        names = zf.namelist()
+    assert len(names) == len(set(names))
+    assert load_bundle(path)['index'] == obj
+
+
+class RecSchema(Schema):
+    rec = Array()
+    empty = Array(dtype=float)
+
+
+def test_bundle_raw_recarray(tmpdir):
+    rec = np.rec.fromrecords([(1, 2.5, b'a'), (2, 3.5, b'bc')],
+                             names='i,f,s')
+    obj = RecSchema(rec=rec, empty=np.empty((0, 3)))
+
+    path = str(tmpdir.join('out.zip'))
+    bundle_schema(path, {'rec': obj}, 'raw')
+    with zipfile.ZipFile(path) as zf:
+        assert set(zf.namelist()) == {'schema/rec/rec.bin', 'index.json'}
+    loaded = load_bundle(path)['rec']
+
+    assert isinstance(loaded.rec, np.recarray)
+    assert loaded.rec.dtype == rec.dtype
+    assert_equal(loaded.rec, rec)
+    assert loaded.empty.shape == (0, 3)
+
+    loaded.rec.i[0] = 10
+    assert loaded.rec.i[0] == 10
+
+
+def test_bundle_raw_structured_dtypes(tmpdir):
+    dtype = np.dtype([('a', 'u1'), (('title', 'b'), '<f8'), ('c', '<i4', (3,)),
+                      ('d', [('e', 'u1'), ('f', '<f4')])], align=True)
+    data = np.zeros(2, dtype=dtype)
+    data['a'] = [1, 2]
+    data['b'] = [1.5, 2.5]
+    data['c'] = [[1, 2, 3], [4, 5, 6]]
+    data['d']['f'] = [0.5, 0.25]
+    obj = RecSchema(rec=data, empty=np.empty(0))
+
+    path = str(tmpdir.join('out.zip'))
+    bundle_schema(path, {'rec': obj}, 'raw')
+    loaded = load_bundle(path)['rec']
+
+    # Padding from alignment is kept rather than turned into fields
+    assert loaded.rec.dtype == dtype
+    assert loaded.rec.dtype.itemsize == dtype.itemsize
+    assert_equal(loaded.rec, data)
+
+
+class FloatSchema(Schema):
+    a = Float()
+    b = Float()
+
+
+def test_bundle_raw_non_finite(tmpdir):
+    path = str(tmpdir.join('out.zip'))
+    bundle_schema(path, {'f': FloatSchema(a=float('nan'), b=float('-inf'))},
+                  'raw')
+    loaded = load_bundle(path)['f']
+    assert np.isnan(loaded.a)
+    assert loaded.b == float('-inf')
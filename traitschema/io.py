@@ -1,14 +1,48 @@
-import contextlib
-import hashlib
+from __future__ import absolute_import
+
 from importlib import import_module
+import io
 import json
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
 import os.path as osp
-import shutil
-from tempfile import mkdtemp
-from zipfile import ZipFile
+import tempfile
+from zipfile import ZipFile, ZIP_STORED
+
+try:
+    from urllib.parse import quote
+except ImportError:  # Python 2
+    from urllib import quote
+
+import numpy as np
+
+from .schema import _NumpyJsonEncoder, _loads_json
 
 BUNDLE_VERSION = 1
 
+# Leading bytes identifying archive formats. Only zip archives can currently
+# be used for bundles; the others are recognized to give better errors.
+_ARCHIVE_MAGIC = (
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),  # empty archive
+    (b'\x1f\x8b', 'gztar'),
+    (b'BZh', 'bztar'),
+    (b'\xfd7zXZ', 'xztar'),
+)
+
+_ARCHIVE_EXTENSIONS = {
+    '.zip': 'zip',
+    '.tar.gz': 'gztar',
+    '.tgz': 'gztar',
+    '.tar.bz2': 'bztar',
+    '.tar.xz': 'xztar',
+    '.tar': 'tar',
+}
+
+# Schema classes already resolved by _resolve, keyed on (module, classname)
+_resolved_classes = {}
+
 
 class UnsupportedArchiveFormat(Exception):
     """Raised when a file extension doesn't match up with a supported archive
@@ -17,11 +51,155 @@ class UnsupportedArchiveFormat(Exception):
     """
 
 
-@contextlib.contextmanager
-def tempdir():
-    dirname = mkdtemp()
-    yield dirname
-    shutil.rmtree(dirname)
+def _get_archive_format(filename, sniff=True):
+    """Determine the archive format of ``filename``.
+
+    Parameters
+    ----------
+    filename : str
+    sniff : bool
+        When True and the file exists, detect the format from the file's
+        leading bytes rather than its extension.
+
+    Returns
+    -------
+    str or None
+        The archive format (e.g., ``'zip'``) or None if it is not recognized.
+
+    """
+    if sniff and osp.isfile(filename):
+        with open(filename, 'rb') as f:
+            head = f.read(512)
+        for magic, format in _ARCHIVE_MAGIC:
+            if head.startswith(magic):
+                return format
+        if head[257:262] == b'ustar':
+            return 'tar'
+        return None
+
+    lowered = filename.lower()
+    for ext, format in _ARCHIVE_EXTENSIONS.items():
+        if lowered.endswith(ext):
+            return format
+    return None
+
+
+def _serialize_schema(key, obj, format):
+    """Serialize a single schema for bundling.
+
+    Returns
+    -------
+    key : str
+    entry : dict
+        Index entry for the serialized schema.
+    members : list
+        A list of ``(filename, bytes)`` tuples to write to the archive.
+
+    """
+    # Escape keys so they are safe to use as archive member names while
+    # remaining readable. Members go in a directory of their own so they can't
+    # clash with the bundle index.
+    basename = 'schema/' + quote(key.encode('utf-8'), safe='')
+    entry = {
+        'classname': obj.__class__.__name__,
+        'module': obj.__class__.__module__,
+    }
+
+    if format != 'raw':
+        entry['filename'] = basename + '.' + format
+        return key, entry, [(entry['filename'], obj.to_bytes(format))]
+
+    entry['format'] = 'raw'
+    entry['arrays'] = {}
+    entry['scalars'] = {}
+    members = []
+
+    for name, is_array, _, _ in obj._trait_plan():
+        value = getattr(obj, name)
+        if value is None:
+            continue
+        if not is_array:
+            entry['scalars'][name] = value
+            continue
+
+        value = np.asanyarray(value)
+        if value.dtype.hasobject:
+            raise ValueError(
+                "Object arrays can't be stored in raw bundles: " + name)
+
+        info = {
+            'dtype': np.lib.format.dtype_to_descr(value.dtype),
+            'shape': list(value.shape),
+            'recarray': isinstance(value, np.recarray),
+        }
+        entry['arrays'][name] = info
+
+        # There's no need to write a member for arrays with no data
+        if value.nbytes == 0:
+            info['empty'] = True
+            continue
+
+        info['filename'] = basename + '/' + name + '.bin'
+        members.append((info['filename'], value.tobytes(order='C')))
+
+    return key, entry, members
+
+
+def _descr_from_json(descr):
+    """Restore the tuples of a dtype description read back from JSON, which
+    turns them into lists.
+
+    """
+    if not isinstance(descr, list):
+        return descr
+
+    fields = []
+    for field in descr:
+        name, subtype = field[0], _descr_from_json(field[1])
+        if isinstance(name, list):
+            name = tuple(name)
+        fields.append((name, subtype) + tuple(tuple(x) for x in field[2:]))
+    return fields
+
+
+def _descr_to_dtype(descr):
+    """Convert a dtype description read back from JSON to a dtype.
+
+    :func:`np.lib.format.descr_to_dtype` is used when available (numpy 1.17 or
+    later) since it keeps the padding and offsets of aligned structured
+    dtypes. Older versions of numpy fall back to :class:`np.dtype`, which
+    turns padding into extra fields.
+
+    """
+    descr = _descr_from_json(descr)
+    descr_to_dtype = getattr(np.lib.format, 'descr_to_dtype', None)
+    if descr_to_dtype is not None:
+        return descr_to_dtype(descr)
+    return np.dtype(descr)  # pragma: nocover
+
+
+def _load_raw(zf, cls, entry):
+    """Load a schema stored in the ``'raw'`` bundle format."""
+    kwargs = dict(entry['scalars'])
+
+    for name, info in entry['arrays'].items():
+        dtype = _descr_to_dtype(info['dtype'])
+        shape = tuple(info['shape'])
+
+        if info.get('empty', False):
+            data = np.empty(shape, dtype=dtype)
+        else:
+            # Read into a writable buffer rather than wrapping the immutable
+            # bytes returned by ZipFile.read
+            buf = bytearray(zf.getinfo(info['filename']).file_size)
+            with zf.open(info['filename']) as member:
+                member.readinto(buf)
+            data = np.frombuffer(buf, dtype=dtype).reshape(shape)
+        if info['recarray']:
+            data = data.view(np.recarray)
+        kwargs[name] = data
+
+    return cls(**kwargs)
 
 
 def bundle_schema(outfile, schema, format='npz'):
@@ -35,50 +213,95 @@ def bundle_schema(outfile, schema, format='npz'):
         Dictionary of :class:`Schema` objects to bundle together. Keys are names
         to give each schema and are used when loading a bundle.
     format : str
-        Format to save individual schema as (default: ``'npz'``).
+        Format to save individual schema as (default: ``'npz'``). Use
+        ``'raw'`` to store each array trait as a raw binary member of the
+        archive with its dtype and shape recorded in the bundle index.
 
     Notes
     -----
     Default options are used with all saving functions (e.g., no compression
     is used for individual serialized schema).
 
+    Schema are serialized in memory and written directly to the archive. When
+    bundling more than one schema, they are serialized concurrently in a pool
+    of threads. The archive is written to a temporary file in the same
+    directory and only replaces ``outfile`` once complete, so an existing
+    bundle is left intact if anything fails.
+
+    The ``'raw'`` format avoids nesting an archive (npz) or container (HDF5)
+    inside the bundle. Arrays with an object dtype can't be stored this way.
+
     """
-    if not outfile.endswith('.zip'):
+    # The output file may already exist, so only look at the extension
+    if _get_archive_format(outfile, sniff=False) != 'zip':
         raise UnsupportedArchiveFormat
-    basename, ext = osp.splitext(outfile)
-    archive_format = ext.lstrip('.')
 
-    with tempdir() as staging_dir:
-        index = {
-            'schema': {},
-            'bundle_version': BUNDLE_VERSION,
-        }
+    index = {
+        'schema': {},
+        'bundle_version': BUNDLE_VERSION,
+    }
+
+    def serialize(item):
+        return _serialize_schema(item[0], item[1], format)
+
+    items = list(schema.items())
+    pool = ThreadPool(min(len(items), cpu_count())) if len(items) > 1 else None
+
+    fd, tmpname = tempfile.mkstemp(suffix='.zip', prefix='.bundle-',
+                                   dir=osp.dirname(osp.abspath(outfile)))
+    try:
+        results = pool.imap(serialize, items) if pool else map(serialize, items)
+
+        # Schema are serialized in memory and written to the archive from this
+        # thread as they become available
+        with os.fdopen(fd, 'wb') as f, \
+                ZipFile(f, 'w', compression=ZIP_STORED, allowZip64=True) as zf:
+            for key, entry, members in results:
+                for filename, data in members:
+                    zf.writestr(filename, data)
+                index['schema'][key] = entry
+
+            zf.writestr('index.json', json.dumps(index, cls=_NumpyJsonEncoder))
 
-        for key, obj in schema.items():
-            basename = hashlib.sha1(key.encode()).hexdigest() + '.' + format
-            filename = osp.join(staging_dir, basename)
-            obj.save(filename)
-            index['schema'][key] = {
-                'filename': basename,
-                'classname': obj.__class__.__name__,
-                'module': obj.__class__.__module__,
-            }
+        # mkstemp creates files only readable by the owner, so use the
+        # permissions a newly created file would normally get
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+        os.replace(tmpname, outfile)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-        with open(osp.join(staging_dir, 'index.json'), 'w') as f:
-            f.write(json.dumps(index))
 
-        archve_filename = shutil.make_archive(basename, archive_format,
-                                              staging_dir)
-        shutil.move(archve_filename, outfile)
+def _resolve(module, classname):
+    """Import ``module`` and return its ``classname`` attribute. Results are
+    cached since bundles typically contain many schema of the same class.
+
+    """
+    try:
+        return _resolved_classes[(module, classname)]
+    except KeyError:
+        cls = getattr(import_module(module), classname)
+        _resolved_classes[(module, classname)] = cls
+        return cls
 
 
-def load_bundle(filename):
+def load_bundle(filename, keys=None):
     """Loads a bundle of schema saved with :func:`bundle_schema`.
 
     Parameters
     ----------
-    filename : str
-        Path to bundled schema archive.
+    filename : str or file-like
+        Path to bundled schema archive or a seekable binary file object
+        containing it.
+    keys : Iterable[str] or None
+        Keys of the schema to load. Other schema in the bundle are not read.
+        When None (the default), all schema are loaded.
 
     Returns
     -------
@@ -87,21 +310,48 @@ def load_bundle(filename):
         bundling. Additionally, a ``__meta__`` key will contain other info that
         was stored when saved (e.g., bundling format version number).
 
+    Raises
+    ------
+    KeyError
+        When any of ``keys`` are not in the bundle.
+    TypeError
+        When ``keys`` is a single string rather than an iterable of keys.
+
     """
-    with tempdir() as path:
-        with ZipFile(filename) as zf:
-            zf.extractall(path)
+    if isinstance(keys, str):
+        raise TypeError("keys must be an iterable of keys, not a string")
 
-        with open(osp.join(path, 'index.json')) as f:
-            index = json.loads(f.read())
+    # File objects are handed straight to ZipFile
+    if isinstance(filename, str) and _get_archive_format(filename) != 'zip':
+        raise UnsupportedArchiveFormat
+
+    with ZipFile(filename) as zf:
+        # Parse the raw bytes to skip decoding to str when possible
+        index = _loads_json(zf.read('index.json'))
 
         schema = {
             '__meta__': {k: v for k, v in index.items() if k != 'schema'}
         }
 
-        for key, value in index['schema'].items():
-            mod = import_module(value['module'])
-            cls = getattr(mod, value['classname'])
-            schema[key] = cls.load(osp.join(path, value['filename']))
+        entries = index['schema']
+        if keys is not None:
+            keys = frozenset(keys)
+            missing = keys.difference(entries)
+            if missing:
+                raise KeyError("keys {} not found in bundle (known keys: {})"
+                               .format(sorted(missing), sorted(entries)))
+            # Keep the order of the bundle
+            entries = {key: value for key, value in entries.items()
+                       if key in keys}
+
+        for key, value in entries.items():
+            cls = _resolve(value['module'], value['classname'])
+            if value.get('format') == 'raw':
+                schema[key] = _load_raw(zf, cls, value)
+                continue
+
+            format = osp.splitext(value['filename'])[1].lstrip('.')
+            member = io.BytesIO(zf.read(value['filename']))
+            schema[key] = cls.load_from_fileobj(member, format)
 
     return schema
@@ -1,7 +1,19 @@
-from __future__ import division
+from __future__ import absolute_import, division
 
+from contextlib import contextmanager
+import io
+import itertools
 import json
+import keyword
+import logging
+import math
+from multiprocessing.pool import ThreadPool
+import os
 import os.path as osp
+import re
+import struct
+from zipfile import ZipFile, ZIP_STORED
+import zlib
 
 import numpy as np
 from traits.api import HasTraits
@@ -12,6 +24,31 @@ try:
 except ImportError:  # pragma: nocover
     h5py = None
 
+try:
+    import hdf5plugin
+except ImportError:  # pragma: nocover
+    hdf5plugin = None
+
+try:
+    import orjson
+except ImportError:  # pragma: nocover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: nocover
+    ujson = None
+
+# JSON library to use, in order of preference
+if orjson is not None:
+    _JSON_BACKEND = 'orjson'
+elif ujson is not None:  # pragma: nocover
+    _JSON_BACKEND = 'ujson'
+else:  # pragma: nocover
+    _JSON_BACKEND = 'json'
+
+logger = logging.getLogger(__name__)
+
 
 class OptionalDependencyMissingError(Exception):
     """Raised when an optional dependency such as h5py is required but not
@@ -20,18 +57,729 @@ class OptionalDependencyMissingError(Exception):
     """
 
 
+_RECARRAY_JSON_ERROR = "Recarrays are not currently supported when saving to json"
+
+
+def _json_default(o):
+    """Convert numpy objects which JSON libraries can't serialize natively.
+    Used as the ``default`` hook for both :mod:`orjson` and the standard
+    library.
+
+    """
+    # TODO: Figure out the right way to do this that maintains dtypes
+    if isinstance(o, np.recarray):
+        raise RuntimeError(_RECARRAY_JSON_ERROR)
+    elif isinstance(o, np.ndarray):
+        return o.tolist()
+    elif isinstance(o, np.generic):
+        return o.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(o).__name__))
+
+
+def _orjson_default(o):
+    """``default`` hook for :mod:`orjson`.
+
+    Numeric arrays which orjson rejects only because they aren't C-contiguous
+    (e.g., slices and transposes) are copied into contiguous arrays so that
+    orjson still serializes them directly from the numpy buffer rather than
+    via :meth:`np.ndarray.tolist`.
+
+    """
+    if isinstance(o, np.ndarray) and o.dtype.kind in 'biuf' and \
+            not o.flags.c_contiguous:
+        return np.ascontiguousarray(o)
+    return _json_default(o)
+
+
+def _native_byte_order(a):
+    """Return ``a`` with its dtype in native byte order, copying if needed.
+    :mod:`orjson` reads array buffers as native values regardless of the
+    dtype's byte order.
+
+    """
+    if a.dtype.isnative:
+        return a
+    return a.astype(a.dtype.newbyteorder('='))
+
+
+def _orjson_checks_byte_order():
+    """Return True if the installed :mod:`orjson` refuses to serialize arrays
+    with a non-native byte order. Older versions silently misread them.
+
+    """
+    swapped = np.zeros(1, dtype=np.dtype(float).newbyteorder('S'))
+    try:
+        orjson.dumps(swapped, option=orjson.OPT_SERIALIZE_NUMPY)
+    except orjson.JSONEncodeError:
+        return True
+    return False
+
+
+_ORJSON_CHECKS_BYTE_ORDER = orjson is not None and _orjson_checks_byte_order()
+
+_CONTAINER_TYPES = (np.ndarray, dict, list, tuple)
+_NUMBER_TYPES = {float, int, bool}
+_FLOAT_HOLDING_TYPES = (float, np.generic) + _CONTAINER_TYPES
+
+
+def _has_non_native(value):
+    """Return True if ``value`` contains an array with a non-native byte order
+    nested inside a container.
+
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'O':
+            return _has_non_native(value.tolist())
+        return not value.dtype.isnative
+    elif isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    else:
+        return False
+
+    # Collecting the types of the items runs in C, so containers holding only
+    # scalars (e.g., long lists of floats) aren't walked in Python
+    if not any(issubclass(kind, _CONTAINER_TYPES)
+               for kind in set(map(type, items))):
+        return False
+    return any(_has_non_native(item) for item in items)
+
+
 class _NumpyJsonEncoder(json.JSONEncoder):
     def default(self, o):
-        # TODO: Figure out the right way to do this that maintains dtypes
-        if isinstance(o, np.recarray):
-            raise RuntimeError("Recarrays are not currently supported when "
-                               "saving to json")
-        elif isinstance(o, np.ndarray):
-            return o.tolist()
-        else:
+        try:
+            return _json_default(o)
+        except TypeError:
             return json.JSONEncoder.default(self, o)
 
 
+def _memmap_npz(filename, mmap_mode='r'):
+    """Memory-map the members of an npz archive.
+
+    Members which are stored without compression are mapped in place by parsing
+    their NPY headers directly. Compressed members, scalars and arrays of Python
+    objects can't be mapped and are instead read with :func:`np.load`.
+
+    Parameters
+    ----------
+    filename : str
+    mmap_mode : str
+        Mode to pass to :class:`np.memmap`. Only the read-only ``'r'`` and
+        copy-on-write ``'c'`` modes are allowed since writing would corrupt
+        the archive (default: ``'r'``).
+
+    Returns
+    -------
+    arrays : dict
+
+    Raises
+    ------
+    ValueError
+        When ``mmap_mode`` is not ``'r'`` or ``'c'``.
+
+    """
+    if mmap_mode not in ('r', 'c'):
+        raise ValueError("mmap_mode must be 'r' or 'c', not {!r}".format(
+            mmap_mode))
+
+    arrays = {}
+    fallback = []
+
+    with ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            key = info.filename
+            if key.endswith('.npy'):
+                key = key[:-len('.npy')]
+
+            if info.compress_type != ZIP_STORED:
+                fallback.append(key)
+                continue
+
+            # The local file header can have a different extra field than the
+            # central directory, so read its lengths from the header itself
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            try:
+                version = np.lib.format.read_magic(f)
+            except ValueError:
+                fallback.append(key)
+                continue
+
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+
+            if dtype.hasobject or not shape:
+                fallback.append(key)
+                continue
+
+            arrays[key] = np.memmap(filename, dtype=dtype, mode=mmap_mode,
+                                    shape=shape, offset=f.tell(),
+                                    order='F' if fortran_order else 'C')
+
+    if fallback:
+        with np.load(filename) as npz:
+            for key in fallback:
+                arrays[key] = npz[key]
+
+    return arrays
+
+
+def _auto_chunks(shape, itemsize, target=1 << 20):
+    """Pick an HDF5 chunk shape close to, but not exceeding, ``target`` bytes.
+
+    Starting from the full dataset shape, the largest dimension is halved until
+    the chunk fits within the target size.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the dataset.
+    itemsize : int
+        Size in bytes of a single element.
+    target : int
+        Target chunk size in bytes (default: 1 MiB).
+
+    Returns
+    -------
+    chunks : tuple or None
+        The chunk shape or None if the data is scalar or empty and can't be
+        chunked.
+
+    """
+    # HDF5 doesn't allow chunks larger than a fixed-size dataset, which rules
+    # out chunking empty datasets
+    if not shape or 0 in shape:
+        return None
+
+    chunks = list(shape)
+    while np.prod(chunks) * itemsize > target and max(chunks) > 1:
+        i = chunks.index(max(chunks))
+        chunks[i] = (chunks[i] + 1) // 2
+    return tuple(chunks)
+
+
+def _pad_chunk(data, chunks):
+    """Pad a partial chunk at the edge of a dataset with zeros to the full
+    chunk shape.
+
+    """
+    if data.shape != chunks:
+        padded = np.zeros(chunks, dtype=data.dtype)
+        padded[tuple(slice(0, n) for n in data.shape)] = data
+        data = padded
+    return np.ascontiguousarray(data)
+
+
+def _compress_chunk(data, chunks, level, shuffle):
+    """Compress a single chunk the same way HDF5's shuffle and deflate
+    filters would. Partial chunks at the edges are padded with zeros.
+
+    """
+    data = _pad_chunk(data, chunks)
+    raw = data.tobytes()
+    if shuffle and data.dtype.itemsize > 1:
+        raw = np.frombuffer(raw, dtype=np.uint8)\
+            .reshape(-1, data.dtype.itemsize).T.tobytes()
+    return zlib.compress(raw, level)
+
+
+@contextmanager
+def _thread_pool(max_workers):
+    """Context manager yielding a :class:`ThreadPool` with ``max_workers``
+    threads, or None when ``max_workers`` is 1 or less.
+
+    """
+    if max_workers <= 1:
+        yield None
+        return
+
+    pool = ThreadPool(max_workers)
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _create_dataset(hfile, path, data, chunks, compression_kwargs,
+                    pool=None, direct_chunk=False):
+    """Create an HDF5 dataset.
+
+    When gzip compression is requested and a thread ``pool`` is given, chunks
+    are compressed concurrently in the pool (:mod:`zlib` releases the GIL
+    while compressing) and written with ``write_direct_chunk``,
+    bypassing HDF5's serial filter pipeline. Likewise, when ``direct_chunk``
+    is True and no compression is used, chunks of numeric arrays are written
+    directly as raw bytes. Otherwise this simply calls
+    :meth:`h5py.Group.create_dataset`.
+
+    """
+    chunked = bool(chunks) and data.size > 0
+    parallel = (chunked and pool is not None and
+                compression_kwargs.get('compression') == 'gzip' and
+                not data.dtype.hasobject)
+    direct = (chunked and direct_chunk and not compression_kwargs and
+              data.dtype.kind in 'biufc')
+    if not (parallel or direct):
+        return hfile.create_dataset(path, data=data, chunks=chunks,
+                                    track_times=False, **compression_kwargs)
+
+    dset = hfile.create_dataset(path, shape=data.shape, dtype=data.dtype,
+                                chunks=chunks, track_times=False,
+                                **compression_kwargs)
+
+    offsets = list(itertools.product(*[range(0, dim, chunk)
+                                       for dim, chunk in zip(data.shape, chunks)]))
+
+    def block(offset):
+        return data[tuple(slice(start, start + chunk)
+                          for start, chunk in zip(offset, chunks))]
+
+    if direct:
+        # No filters are applied, so the stored chunk is just its bytes
+        for offset in offsets:
+            dset.id.write_direct_chunk(
+                offset, _pad_chunk(block(offset), chunks).tobytes())
+        return dset
+
+    level = compression_kwargs.get('compression_opts')
+    level = 4 if level is None else level
+    shuffle = compression_kwargs.get('shuffle', False)
+
+    def compress(offset):
+        return _compress_chunk(block(offset), chunks, level, shuffle)
+
+    # h5py isn't safe to call from multiple threads, so only compression
+    # happens in the pool and chunks are written from this thread
+    for offset, compressed in zip(offsets, pool.imap(compress, offsets)):
+        dset.id.write_direct_chunk(offset, compressed)
+
+    return dset
+
+
+def _tag_array(a):
+    """Wrap an array in an object recording its dtype and shape so that it can
+    be reconstructed by :func:`_untag_array` without inferring the dtype.
+
+    """
+    return {
+        '__ndarray__': True,
+        'dtype': a.dtype.str,
+        'shape': list(a.shape),
+        'data': _native_byte_order(a).ravel(),
+    }
+
+
+def _untag_array(value):
+    """Reconstruct arrays encoded with :func:`_tag_array`. Other values are
+    returned unchanged.
+
+    """
+    if isinstance(value, dict) and value.get('__ndarray__') is True:
+        return np.asarray(value['data'], dtype=value['dtype'])\
+            .reshape(value['shape'])
+    return value
+
+
+def _orjson_option(json_kwargs):
+    """Translate :func:`json.dumps` keyword arguments into :mod:`orjson`
+    options. Returns None when orjson is not available or can't honor the
+    requested arguments.
+
+    """
+    if _JSON_BACKEND != 'orjson':
+        return None
+
+    # Non-str keys are allowed to match the standard library, which converts
+    # int, float, bool and None keys to strings
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    for key, value in json_kwargs.items():
+        if key == 'indent' and value in (None, 2):
+            if value == 2:
+                option |= orjson.OPT_INDENT_2
+        elif key == 'sort_keys':
+            if value:
+                option |= orjson.OPT_SORT_KEYS
+        elif key != 'cls':
+            return None
+    return option
+
+
+def _read_json(data):
+    """Return the contents of a JSON string, bytes or file object.
+
+    When ``data`` is a seekable UTF-8 text file which hasn't been read from
+    yet, the underlying binary buffer is read directly to skip decoding in
+    Python. Streams such as pipes are always read through the text layer.
+
+    """
+    if not hasattr(data, 'read'):
+        return data
+
+    buffer = getattr(data, 'buffer', None)
+    encoding = (getattr(data, 'encoding', None) or '').lower().replace('-', '')
+    if (buffer is not None and encoding in ('utf8', 'ascii') and
+            data.seekable() and data.tell() == 0):
+        return buffer.read()
+    return data.read()
+
+
+def _loads_json(data):
+    """Decode a JSON str or bytes with the fastest available JSON library.
+
+    The standard library is used as a fallback for anything the faster
+    libraries reject, notably the ``NaN`` and ``Infinity`` tokens it writes for
+    non-finite floats.
+
+    """
+    if _JSON_BACKEND == 'orjson':
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    elif _JSON_BACKEND == 'ujson':  # pragma: nocover
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            pass
+    if isinstance(data, bytes) and not isinstance(data, str):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def _has_non_finite(value):
+    """Return True if ``value`` is or contains a NaN or infinite float.
+
+    :mod:`orjson` encodes these as ``null``, so payloads containing them must
+    be encoded with the standard library to round trip. Only used once
+    orjson's output contains a ``null``. May give false positives for sums
+    which overflow, which only means using the slower standard library.
+
+    """
+    if isinstance(value, float):
+        return not math.isfinite(value)
+    elif isinstance(value, np.ndarray):
+        if value.dtype.kind in 'fc':
+            return not np.isfinite(value).all()
+        elif value.dtype.kind == 'O':
+            return _has_non_finite(value.tolist())
+        return False
+    elif isinstance(value, np.generic):
+        return value.dtype.kind in 'fc' and not np.isfinite(value)
+    elif isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    else:
+        return False
+
+    # Collecting the types of the items and summing plain numbers both run in
+    # C, so long lists of numbers aren't walked in Python
+    kinds = set(map(type, items))
+    if kinds <= _NUMBER_TYPES:
+        try:
+            return not math.isfinite(sum(items, 0.0))
+        except OverflowError:
+            return True
+    if not any(issubclass(kind, _FLOAT_HOLDING_TYPES) for kind in kinds):
+        return False
+    return any(_has_non_finite(item) for item in items)
+
+
+def _dumps_json(data, json_kwargs, fp=None):
+    """Encode ``data`` with the fastest available JSON library which supports
+    the given :func:`json.dumps` keyword arguments.
+
+    If the standard library ends up being used and a text file object ``fp`` is
+    given, output is streamed to it with :func:`json.dump` instead.
+
+    Returns
+    -------
+    Encoded JSON as bytes when using :mod:`orjson`, None if streamed to ``fp``,
+    otherwise as str.
+
+    """
+    option = _orjson_option(json_kwargs)
+    if option is not None:
+        # Top level arrays are cheap to convert. Anything else which orjson
+        # would misread is left to the standard library. Newer versions of
+        # orjson raise an error instead, which is handled below.
+        native = {
+            key: _native_byte_order(value)
+            if isinstance(value, np.ndarray) else value
+            for key, value in data.items()
+        }
+        if _ORJSON_CHECKS_BYTE_ORDER or not _has_non_native(native):
+            try:
+                encoded = orjson.dumps(native, default=_orjson_default,
+                                       option=option)
+            except orjson.JSONEncodeError:
+                pass
+            else:
+                # Searching the output is much cheaper than checking every
+                # float up front
+                if b'null' not in encoded or not _has_non_finite(data):
+                    return encoded
+
+    if _JSON_BACKEND == 'ujson' and \
+            set(json_kwargs).issubset({'indent', 'sort_keys', 'cls'}):
+        encoder = _NumpyJsonEncoder()
+        converted = {
+            key: encoder.default(value)
+            if isinstance(value, (np.ndarray, np.generic)) else value
+            for key, value in data.items()
+        }
+        try:
+            return ujson.dumps(converted,
+                               indent=json_kwargs.get('indent') or 0,
+                               sort_keys=json_kwargs.get('sort_keys', False))
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+    json_kwargs = dict(json_kwargs, cls=_NumpyJsonEncoder)
+    if fp is not None:
+        json.dump(data, fp, **json_kwargs)
+        return None
+    return json.dumps(data, **json_kwargs)
+
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _attr_expr(obj, name):
+    """Return source code which reads the attribute ``name`` of the object
+    named ``obj`` for use in generated methods.
+
+    """
+    if _IDENTIFIER.match(name) and not keyword.iskeyword(name):
+        return '{}.{}'.format(obj, name)
+    return 'getattr({}, {!r})'.format(obj, name)
+
+
+def _write_json(fp, encoded):
+    """Write encoded JSON, given as either str or bytes, to a file object
+    opened in text or binary mode.
+
+    """
+    text_file = isinstance(fp, io.TextIOBase)
+    if text_file and isinstance(encoded, bytes):
+        encoded = encoded.decode('utf-8')
+    elif not text_file and not isinstance(encoded, bytes):
+        encoded = encoded.encode('utf-8')
+    fp.write(encoded)
+
+
+def _convert_string_fields(data, kind, convert, char):
+    """Convert the string fields of a structured array.
+
+    Fields of the given dtype ``kind`` are converted with ``convert`` (e.g.,
+    :func:`numpy.char.encode`) and stored as strings of type ``char`` (``'S'``
+    or ``'U'``) at least 256 characters long. Other fields are copied straight
+    into the preallocated output rather than being cast along with the whole
+    array. Arrays without any fields of the given kind are returned as is.
+
+    """
+    names = data.dtype.names
+    if not any(data.dtype[name].kind == kind for name in names):
+        return data
+
+    dtypes = []
+    fields = []
+    for name in names:
+        field_dtype = data.dtype[name]
+        values = data[name]
+        if field_dtype.kind == kind:
+            values = convert(values)
+            length = values.dtype.itemsize // np.dtype(char + '1').itemsize
+            field_dtype = np.dtype(char + str(max(length, 256)))
+        dtypes.append((name, field_dtype))
+        fields.append((name, values))
+
+    out = np.empty(data.shape, dtype=dtypes)
+    for name, values in fields:
+        out[name] = values
+    return out.view(type(data))
+
+
+def _read_hdf_dataset(dset, is_array, dtype, decode_string_arrays, encoding):
+    """Read a dataset written by :meth:`Schema.to_hdf`.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset or h5py.Group
+        Record arrays written with ``soa=True`` are stored as a group with one
+        dataset per field.
+    is_array : bool
+        Whether the dataset is for an array trait.
+    dtype : np.dtype or None
+        The dtype declared by the trait, if any.
+    decode_string_arrays : bool
+    encoding : str
+
+    """
+    if isinstance(dset, h5py.Group):
+        fields = json.loads(dset.attrs['fields'])
+        data = np.rec.fromarrays([dset[field][()] for field in fields],
+                                 names=fields)
+
+    # When the trait declares a numeric dtype, read straight into a buffer of
+    # that type and let HDF5 do any conversion
+    elif (is_array and dtype is not None and
+            dtype.kind in 'biufc' and dset.dtype.kind in 'biufc'):
+        data = np.empty(dset.shape, dtype=dtype)
+        if data.size:
+            dset.read_direct(data)
+    else:
+        data = dset[()]
+
+        # h5py 3 returns bytes when reading string scalars
+        if not is_array and isinstance(data, bytes):
+            string_info = h5py.check_string_dtype(dset.dtype)
+            if string_info is not None:
+                data = data.decode(string_info.encoding)
+
+    if is_array and decode_string_arrays:
+        # Recarrays are stored as compound datasets or groups of fields, so
+        # the dtype tells us how to proceed
+        data_is_recarray = data.dtype.names is not None
+
+        # Decode arrays containing bytes in a single vectorized call
+        if not data_is_recarray and data.dtype.kind == 'S':
+            data = np.char.decode(data, encoding)
+
+        elif data_is_recarray:
+            data = _convert_string_fields(
+                data, 'S', lambda values: np.char.decode(values, encoding),
+                'U')
+
+    return data
+
+
+class _LazyHDFSchema(object):
+    """Proxy returned by :meth:`Schema.from_hdf_lazy` which reads each trait
+    from an open HDF5 file the first time it is accessed.
+
+    The file stays open until :meth:`load` or :meth:`close` is called, the
+    proxy is used as a context manager or it is garbage collected.
+
+    """
+    def __init__(self, cls, filename, decode_string_arrays, encoding):
+        self._cls = cls
+        self._schema = cls()
+        self._loaded = set()
+        self._decode_string_arrays = decode_string_arrays
+        self._encoding = encoding
+        self._plan = {name: (is_array, dtype)
+                      for name, is_array, dtype, _ in cls._trait_plan()}
+        self._hfile = h5py.File(filename, 'r', rdcc_nbytes=64 * 1024 * 1024,
+                                rdcc_nslots=10007)
+
+        self._packed = {}
+        if 'packed' in self._hfile.attrs:
+            table = json.loads(self._hfile.attrs['packed'])
+            for dtype_name, entries in table.items():
+                for entry in entries:
+                    self._packed[entry['name']] = (dtype_name, entry)
+
+        self._scalars = set()
+        if 'scalars' in self._hfile.attrs:
+            self._scalars.update(json.loads(self._hfile.attrs['scalars']))
+
+    def __getattr__(self, name):
+        # Only called when regular lookup fails, i.e., for trait names
+        if name.startswith('_') or name not in self._plan:
+            raise AttributeError(name)
+        if name not in self._loaded:
+            self._load_trait(name)
+        return getattr(self._schema, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _load_trait(self, name):
+        if self._hfile is None:
+            raise ValueError("HDF5 file has already been closed")
+
+        is_array, dtype = self._plan[name]
+        if name in self._packed:
+            dtype_name, entry = self._packed[name]
+            start = entry['offset']
+            stop = start + int(np.prod(entry['shape']))
+            data = self._hfile['/packed_' + dtype_name][start:stop]
+            setattr(self._schema, name, data.reshape(entry['shape']))
+        elif name in self._scalars:
+            setattr(self._schema, name, self._hfile.attrs[name])
+        else:
+            dset = self._hfile.get(self._cls._hdf_paths()[name])
+            if dset is not None:
+                setattr(self._schema, name, _read_hdf_dataset(
+                    dset, is_array, dtype, self._decode_string_arrays,
+                    self._encoding))
+
+        self._loaded.add(name)
+
+    def load(self):
+        """Read all remaining traits, close the file and return the fully
+        loaded :class:`Schema` instance.
+
+        """
+        for name in self._plan:
+            if name not in self._loaded:
+                self._load_trait(name)
+        self.close()
+        return self._schema
+
+    def close(self):
+        """Close the underlying HDF5 file."""
+        hfile = getattr(self, '_hfile', None)
+        if hfile is not None:
+            self._hfile = None
+            hfile.close()
+
+
+# Names of the attributes used to cache per-class trait introspection results
+_CLASS_CACHES = (
+    '__to_dict_cache__',
+    '__eq_cache__',
+    '__trait_plan_cache__',
+    '__visible_traits_cache__',
+    '__allowed_traits_cache__',
+    '__trait_pairs_cache__',
+    '__hdf_paths_cache__',
+)
+
+# Root attributes used by to_hdf which can't also hold scalar trait values
+_RESERVED_HDF_ATTRS = ('classname', 'python_module', 'packed', 'scalars')
+
+# Serialization methods keyed by file extension. Used by save and load as
+# well as to_bytes and load_from_fileobj, whose formats are the extensions
+# without the leading dot.
+_SAVE_FUNCS = {
+    '.npz': 'to_npz',
+    '.h5': 'to_hdf',
+    '.json': 'to_json',
+}
+_LOAD_FUNCS = {
+    '.npz': 'from_npz',
+    '.h5': 'from_hdf',
+    '.json': 'from_json',
+}
+
+
 class Schema(HasTraits):
     """Extension to :class:`HasTraits` to add methods for automatically saving
     and loading typed data.
@@ -59,41 +807,182 @@ class Schema(HasTraits):
 
     """
     def __init__(self, **kwargs):
-        super(Schema, self).__init__(**kwargs)
+        unknown = set(kwargs).difference(self._allowed_traits())
+        if unknown:
+            raise RuntimeError("trait {} is not in {}".format(
+                ', '.join(sorted(unknown)), self.__class__.__name__
+            ))
 
-        traits = self.class_visible_traits()
-        for key, value in kwargs.items():
-            if key not in traits:
-                raise RuntimeError("trait {} is not in {}".format(
-                    key, self.__class__.__name__
-                ))
-            setattr(self, key, value)
+        # HasTraits assigns (and validates) each keyword argument itself
+        super(Schema, self).__init__(**kwargs)
 
     def __str__(self):  # pragma: nocover
         attr_strs = ["{}={}".format(attr, getattr(self, attr))
-                     for attr in self.visible_traits()]
+                     for attr in self._cached_visible_traits()]
         return "<{}({})>".format(self.__class__.__name__, '\n    '.join(attr_strs))
 
     def __repr__(self):  # pragma: nocover
         return self.__str__()
 
     def __eq__(self, other):
-        for attr in self.visible_traits():
-            this = getattr(self, attr)
-            that = getattr(other, attr)
-            try:
-                if this != that:
-                    return False
-            except AttributeError:
-                return False
-            except ValueError:
-                if not all(this == that):
-                    return False
-        return True
+        return self._compiled_eq()(self, other)
+
+    def __ne__(self, other):
+        return not self == other
 
     def to_dict(self):
         """Return all visible traits as a dictionary."""
-        return {name: getattr(self, name) for name in self.visible_traits()}
+        return self._compiled_to_dict()(self)
+
+    @classmethod
+    def add_class_trait(cls, name, *trait):
+        """Add a trait to the class, invalidating the cached trait information
+        of the class and its subclasses.
+
+        """
+        super(Schema, cls).add_class_trait(name, *trait)
+        cls._clear_class_caches()
+
+    @classmethod
+    def _clear_class_caches(cls):
+        for attr in _CLASS_CACHES:
+            if attr in cls.__dict__:
+                delattr(cls, attr)
+        for subclass in cls.__subclasses__():
+            subclass._clear_class_caches()
+
+    @classmethod
+    def _compiled_to_dict(cls):
+        """Return a ``to_dict`` function specialized for this class.
+
+        The function is generated once per class from the cached trait plan so
+        that it reads each trait with a plain attribute access rather than
+        looping over trait names.
+
+        """
+        func = cls.__dict__.get('__to_dict_cache__')
+        if func is None:
+            items = ['{!r}: {}'.format(name, _attr_expr('self', name))
+                     for name in cls._cached_visible_traits()]
+            source = 'def to_dict(self):\n    return {{{}}}\n'.format(
+                ', '.join(items))
+            func = cls._compile_function(source, 'to_dict')
+            cls.__to_dict_cache__ = func
+        return func
+
+    @classmethod
+    def _compiled_eq(cls):
+        """Return an ``__eq__`` function specialized for this class.
+
+        Like :meth:`_compiled_to_dict`, the comparisons are unrolled into
+        straight-line code. Arrays are compared with :func:`np.array_equal`
+        since ``==`` is elementwise, and any trait missing from the other
+        object makes the two unequal.
+
+        """
+        func = cls.__dict__.get('__eq_cache__')
+        if func is None:
+            names = cls._cached_visible_traits()
+            lines = ['def __eq__(self, other):']
+            if names:
+                lines.append('    try:')
+                for i, name in enumerate(names):
+                    lines.append('        b{} = {}'.format(
+                        i, _attr_expr('other', name)))
+                lines.extend(['    except AttributeError:',
+                              '        return False'])
+            for i, name in enumerate(names):
+                lines.extend([
+                    '    a, b = {}, b{}'.format(_attr_expr('self', name), i),
+                    '    if isinstance(a, ndarray) or isinstance(b, ndarray):',
+                    '        if not array_equal(a, b):',
+                    '            return False',
+                    '    elif a != b:',
+                    '        return False',
+                ])
+            lines.append('    return True\n')
+            func = cls._compile_function(
+                '\n'.join(lines), '__eq__',
+                {'ndarray': np.ndarray, 'array_equal': np.array_equal})
+            cls.__eq_cache__ = func
+        return func
+
+    @classmethod
+    def _compile_function(cls, source, name, namespace=None):
+        """Compile the source of a generated method and return the function
+        ``name`` defined by it.
+
+        """
+        namespace = dict(namespace or {})
+        code = compile(source, '<{}.{}>'.format(cls.__name__, name), 'exec')
+        exec(code, namespace)
+        return namespace[name]
+
+    @classmethod
+    def _trait_plan(cls):
+        """Return a tuple of ``(name, is_array, dtype, shape)`` tuples
+        describing each visible trait of the class.
+
+        Introspecting traits is relatively expensive, so the result is computed
+        once per class and cached.
+
+        """
+        # Look in the class's own namespace so subclasses don't pick up the
+        # cache of their parent
+        plan = cls.__dict__.get('__trait_plan_cache__')
+        if plan is None:
+            traits = cls.class_traits()
+            plan = []
+            for name in cls.class_visible_traits():
+                trait_type = traits[name].trait_type
+                plan.append((name,
+                             traits[name].array is True,
+                             getattr(trait_type, 'dtype', None),
+                             getattr(trait_type, 'shape', None)))
+            plan = tuple(plan)
+            cls.__trait_plan_cache__ = plan
+        return plan
+
+    @classmethod
+    def _cached_visible_traits(cls):
+        """Return a cached tuple of the names of all visible traits."""
+        names = cls.__dict__.get('__visible_traits_cache__')
+        if names is None:
+            names = tuple(name for name, _, _, _ in cls._trait_plan())
+            cls.__visible_traits_cache__ = names
+        return names
+
+    @classmethod
+    def _allowed_traits(cls):
+        """Return a cached frozenset of the names of all visible traits."""
+        allowed = cls.__dict__.get('__allowed_traits_cache__')
+        if allowed is None:
+            allowed = frozenset(cls._cached_visible_traits())
+            cls.__allowed_traits_cache__ = allowed
+        return allowed
+
+    @classmethod
+    def _trait_pairs(cls):
+        """Return a cached tuple of ``(name, trait)`` pairs for all visible
+        traits.
+
+        """
+        pairs = cls.__dict__.get('__trait_pairs_cache__')
+        if pairs is None:
+            traits = cls.class_traits()
+            pairs = tuple((name, traits[name])
+                          for name in cls._cached_visible_traits())
+            cls.__trait_pairs_cache__ = pairs
+        return pairs
+
+    @classmethod
+    def _hdf_paths(cls):
+        """Return a cached mapping of trait names to HDF5 dataset paths."""
+        paths = cls.__dict__.get('__hdf_paths_cache__')
+        if paths is None:
+            paths = {name: '/' + name for name in cls._cached_visible_traits()}
+            cls.__hdf_paths_cache__ = paths
+        return paths
 
     def save(self, filename):
         """Serialize using the type determined by the file extension.
@@ -106,34 +995,72 @@ class Schema(HasTraits):
         Notes
         -----
         Only default saving options are used, so this method is less flexible
-        than using the ``to_xyz`` methods instead.
+        than using the ``to_xyz`` methods instead. Extensions are not case
+        sensitive.
 
         """
-        func = {
-            '.npz': 'to_npz',
-            '.h5': 'to_hdf',
-            '.json': 'to_json',
-        }[osp.splitext(filename)[1]]
+        func = _SAVE_FUNCS[osp.splitext(filename)[1].lower()]
         if func != 'to_json':
             getattr(self, func)(filename)
         else:
-            with open(filename, 'w') as jf:
-                jf.write(getattr(self, func)())
+            with open(filename, 'wb') as jf:
+                self.to_json_file(jf)
 
     @classmethod
     def load(cls, filename):
         """Counterpart to :meth:`save`."""
-        func = {
-            '.npz': 'from_npz',
-            '.h5': 'from_hdf',
-            '.json': 'from_json',
-        }[osp.splitext(filename)[1]]
+        func = _LOAD_FUNCS[osp.splitext(filename)[1].lower()]
         if func != 'from_json':
             return getattr(cls, func)(filename)
         else:
             with open(filename, 'r') as jf:
                 return getattr(cls, func)(jf)
 
+    def to_bytes(self, format):
+        """Serialize to bytes in memory rather than to a file.
+
+        Parameters
+        ----------
+        format : str
+            One of ``'npz'``, ``'h5'`` or ``'json'``.
+
+        Returns
+        -------
+        bytes
+
+        Notes
+        -----
+        As with :meth:`save`, only default saving options are used.
+
+        """
+        if format == 'json':
+            return self.to_json(as_bytes=True)
+
+        func = _SAVE_FUNCS['.' + format]
+        buf = io.BytesIO()
+        getattr(self, func)(buf)
+        return buf.getvalue()
+
+    @classmethod
+    def load_from_fileobj(cls, fobj, format):
+        """Load from an open file object rather than a path.
+
+        Parameters
+        ----------
+        fobj : file-like
+            Binary file object to read from. It must be seekable when loading
+            npz or HDF5 data.
+        format : str
+            One of ``'npz'``, ``'h5'`` or ``'json'``.
+
+        Returns
+        -------
+        Deserialized instance
+
+        """
+        func = _LOAD_FUNCS['.' + format]
+        return getattr(cls, func)(fobj)
+
     def to_npz(self, filename, compress=False):
         """Save in numpy's npz archive format.
 
@@ -149,28 +1076,135 @@ class Schema(HasTraits):
         should be used (e.g., ``CStr`` instead of ``String`` or ``Str``). See
         the :mod:`traits` documentation for details.
 
+        Traits which are None are not stored. Otherwise they would have to be
+        saved as pickled object arrays, which can't be loaded without allowing
+        pickles.
+
         """
         save = np.savez_compressed if compress else np.savez
-        attrs = self.to_dict()
+        attrs = {key: value for key, value in self.to_dict().items()
+                 if value is not None}
         save(filename, **attrs)
 
     @classmethod
-    def from_npz(cls, filename):
+    def from_npz(cls, filename, mmap_mode=None):
         """Load data from numpy's npz format.
 
         Parameters
         ----------
-        filename : str
+        filename : str or file-like
+        mmap_mode : str or None
+            When given, memory-map arrays from uncompressed archives using this
+            mode instead of reading them into memory. Must be ``'r'``
+            (read-only) or ``'c'`` (copy-on-write; see :class:`np.memmap`).
+            Requires ``filename`` to be a path. Default: None.
 
         """
-        npz = np.load(filename)
-        attrs = {key: value for key, value in npz.items()}
+        if mmap_mode is not None:
+            attrs = _memmap_npz(filename, mmap_mode)
+        else:
+            # Read each member once and release the file handle right away
+            with np.load(filename) as npz:
+                attrs = {key: npz[key] for key in npz.files}
         self = cls(**attrs)
         return self
 
+    def to_npy_dir(self, dirname):
+        """Save each trait as a separate ``.npy`` file in a directory.
+
+        Unlike npz archives, individual ``.npy`` files can be memory-mapped
+        when loading with :meth:`from_npy_dir`.
+
+        Parameters
+        ----------
+        dirname : str
+            Directory to save to. It is created if it doesn't exist.
+
+        Notes
+        -----
+        A manifest of the stored traits and their dtypes and shapes is written
+        to ``index.json`` in the same directory. As with :meth:`to_npz`,
+        traits which are None are not stored.
+
+        Non-array traits must be scalars or lists which numpy can convert to
+        arrays without using the object dtype, since loading those would
+        require unpickling.
+
+        Raises
+        ------
+        ValueError
+            When a non-array trait holds a value such as a dict which would
+            have to be pickled.
+
+        """
+        data = self.to_dict()
+        values = {}
+        for name, is_array, _, _ in self._trait_plan():
+            if data[name] is None:
+                continue
+            value = np.asanyarray(data[name])
+            if not is_array and value.dtype.hasobject:
+                raise ValueError(
+                    "Trait {} can't be stored without pickling".format(name))
+            values[name] = value
+
+        if not osp.isdir(dirname):
+            os.makedirs(dirname)
+
+        manifest = {
+            'classname': self.__class__.__name__,
+            'python_module': self.__class__.__module__,
+            'traits': {},
+        }
+
+        for name, value in values.items():
+            np.save(osp.join(dirname, name + '.npy'), value)
+            manifest['traits'][name] = {
+                'dtype': value.dtype.str,
+                'shape': list(value.shape),
+            }
+
+        with open(osp.join(dirname, 'index.json'), 'w') as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def from_npy_dir(cls, dirname, mmap=True):
+        """Load data saved with :meth:`to_npy_dir`.
+
+        Parameters
+        ----------
+        dirname : str
+        mmap : bool
+            Memory-map arrays read-only instead of reading them into memory.
+            Scalars and object arrays are always read. Default: True.
+
+        """
+        with open(osp.join(dirname, 'index.json'), 'rb') as f:
+            manifest = _loads_json(f.read())
+
+        plan = {name: is_array for name, is_array, _, _ in cls._trait_plan()}
+        attrs = {}
+        for name, info in manifest['traits'].items():
+            path = osp.join(dirname, name + '.npy')
+            if not plan.get(name, True):
+                # Lists such as those of List traits were stored as arrays
+                value = np.load(path)
+                attrs[name] = value.item() if value.ndim == 0 \
+                    else value.tolist()
+                continue
+
+            hasobject = np.dtype(info['dtype']).hasobject
+            mmap_mode = 'r' if mmap and info['shape'] and not hasobject \
+                else None
+            attrs[name] = np.load(path, mmap_mode=mmap_mode,
+                                  allow_pickle=hasobject)
+        return cls(**attrs)
+
     def to_hdf(self, filename, mode='w', compression=None,
                compression_opts=None, encode_string_arrays=True,
-               encoding='utf8'):
+               encoding='utf8', pack=False, max_workers=1,
+               scalars_as_attrs=False, libver=None, direct_chunk=False,
+               chunk_size=1 << 20, soa=False):
         """Serialize to HDF5 using :mod:`h5py`.
 
         Parameters
@@ -179,12 +1213,17 @@ class Schema(HasTraits):
             Path to save HDF5 file to.
         mode : str
             Default: ``'w'``
-        compression : str or None
+        compression : str, bool or None
             Compression to use with arrays (see :mod:`h5py` documentation for
-            valid choices).
+            valid choices). Additionally, ``'blosc'`` can be used to compress
+            with Blosc (LZ4 and bit shuffling) if :mod:`hdf5plugin` is
+            installed. Use ``'auto'`` or True to pick a fast compressor: Blosc
+            when :mod:`hdf5plugin` is installed and LZF otherwise. None or
+            False disables compression.
         compression_opts : int or None
             Compression options, generally a number specifying compression level
-            (see :mod:`h5py` documentation for details).
+            (see :mod:`h5py` documentation for details). For Blosc, this is the
+            compression level (default: 5).
         encode_string_arrays : bool
             When True, force encoding of arrays of unicode strings using the
             ``encoding`` keyword argument. Not setting this will result in
@@ -192,9 +1231,46 @@ class Schema(HasTraits):
         encoding : str
             Encoding to use when forcing encoding of unicode string arrays.
             Default: ``'utf8'``.
+        pack : bool
+            When True, numeric arrays sharing a dtype are flattened and stored
+            together in a single ``/packed_<dtype>`` dataset instead of one
+            dataset per trait. This reduces per-dataset overhead when storing
+            many small arrays. Default: False.
+        max_workers : int
+            Number of threads to use for compressing chunks when using gzip
+            compression. The same threads are used for all datasets in the
+            file. Default: 1.
+        scalars_as_attrs : bool
+            When True, scalar (non-array) traits are stored as attributes of the
+            root node instead of as individual datasets. This avoids the
+            overhead of creating a dataset for each scalar. Default: False.
+        libver : str or tuple or None
+            HDF5 library version bounds passed on to :class:`h5py.File`. Using
+            ``'latest'`` enables newer, more compact metadata structures at the
+            cost of files only being readable with HDF5 1.10 or later. Default:
+            None (h5py's default of ``'earliest'``).
+        direct_chunk : bool
+            When True and ``compression`` is None, write the chunks of numeric
+            arrays directly with ``write_direct_chunk``, bypassing HDF5's
+            filter pipeline and chunk cache. Default: False.
+        chunk_size : int
+            Target size in bytes of array chunks. Chunk shapes are picked to be
+            as large as possible without exceeding this. Default: 1 MiB.
+        soa : bool
+            When True, record arrays are stored as a group containing one
+            dataset per field rather than as a single compound dataset. Reading
+            a single field then only touches that field's data, and fields of a
+            single dtype tend to compress better. Default: False.
 
         Notes
         -----
+        Chunk shapes for arrays are chosen to be approximately ``chunk_size``
+        bytes in size.
+        When using gzip or LZF compression, the shuffle filter is also enabled.
+
+        Files written with Blosc compression can be read by :meth:`from_hdf`
+        as long as :mod:`hdf5plugin` is installed.
+
         Each stored dataset will also have a ``desc`` attribute which uses the
         ``desc`` attribute of each trait.
 
@@ -202,68 +1278,160 @@ class Schema(HasTraits):
 
         * ``classname`` - the class name of the instance being serialized
         * ``python_module`` - the Python module in which the class is defined
+        * ``packed`` - when ``pack`` is True, a JSON table of the names, offsets
+          and shapes of the arrays stored in each packed dataset
+        * ``scalars`` - when ``scalars_as_attrs`` is True, a JSON list of the
+          traits stored as root attributes. The ``desc`` of such a trait is
+          stored in the ``<name>__desc`` attribute.
+
+        Groups written for record arrays with ``soa`` set have a ``fields``
+        attribute holding a JSON list of the field names in order.
 
         """
         if h5py is None:  # pragma: nocover
             raise OptionalDependencyMissingError("h5py not found")
 
-        with h5py.File(filename, mode) as hfile:
-            for name in self.class_visible_traits():
-                trait = self.trait(name)
-
+        if compression is True or compression == 'auto':
+            # Both are much faster than gzip while still compressing well
+            compression = 'lzf' if hdf5plugin is None else 'blosc'
+            if compression == 'lzf':
+                compression_opts = None
+        elif compression is False:
+            compression = None
+
+        array_compression_kwargs = {}
+        if compression == 'blosc':
+            if hdf5plugin is None:  # pragma: nocover
+                raise OptionalDependencyMissingError("hdf5plugin not found")
+            clevel = 5 if compression_opts is None else compression_opts
+            array_compression_kwargs.update(
+                hdf5plugin.Blosc(cname='lz4', clevel=clevel,
+                                 shuffle=hdf5plugin.Blosc.BITSHUFFLE)
+            )
+        elif compression is not None:
+            array_compression_kwargs['compression'] = compression
+            if compression_opts is not None:
+                array_compression_kwargs['compression_opts'] = compression_opts
+            if compression in ('gzip', 'lzf'):
+                array_compression_kwargs['shuffle'] = True
+
+        paths = self._hdf_paths()
+        packed = {}
+        scalars = []
+
+        # Threads are only useful for gzip compression. A single pool is
+        # shared by all datasets so threads are only started once per file.
+        if array_compression_kwargs.get('compression') != 'gzip':
+            max_workers = 1
+
+        with h5py.File(filename, mode, libver=libver,
+                       rdcc_nbytes=16 * 1024 * 1024,
+                       rdcc_nslots=10007) as hfile, \
+                _thread_pool(max_workers) as pool:
+            # Read all values at once with the generated to_dict
+            values = self.to_dict()
+
+            # The plan and trait pairs are cached in the same order
+            for (name, is_array, _, _), (_, trait) in zip(self._trait_plan(),
+                                                          self._trait_pairs()):
                 # Workaround for saving arrays containing unicode. When the
                 # data type is unicode, each element is encoded as utf-8
                 # before being saved to hdf5
-                data = getattr(self, name)
+                data = values[name]
 
                 if data is None:
                     # If a trait has not been populated, don't try to store it
                     continue
 
-                data_is_recarray = isinstance(data, np.recarray)
-                if trait.array is True and encode_string_arrays:
-                    # Encode each element of an array containing unicode
-                    # elements
-                    if ~data_is_recarray and data.dtype.char == 'U':
-                        data = [s.encode(encoding) for s in data]
+                if (scalars_as_attrs and not is_array and np.isscalar(data) and
+                        name not in _RESERVED_HDF_ATTRS):
+                    hfile.attrs[name] = data
+                    if trait.desc is not None:
+                        hfile.attrs[name + '__desc'] = trait.desc
+                    scalars.append(name)
+                    continue
+
+                # Only arrays need any further inspection
+                data_is_recarray = is_array and isinstance(data, np.recarray)
+                if is_array and encode_string_arrays:
+                    # Encode arrays containing unicode elements in a single
+                    # vectorized call
+                    if not data_is_recarray and data.dtype.kind == 'U':
+                        data = np.char.encode(data, encoding)
 
                     elif data_is_recarray:
-                        # Determine what the final dtypes will be
-                        final_dtypes = []
-                        unicode_fields = []
-                        for i, field in enumerate(data.dtype.names):
-                            if data[field].dtype.kind != 'U':
-                                final_dtypes.append((field,
-                                                     data[field].dtype.str))
-                            else:
-                                final_dtypes.append((field, '<S256'))
-                                unicode_fields.append(field)
-
-                        # Update dtypes of the data. This will coerce the
-                        # unicode fields to bytes automatically
-                        data = data.astype(final_dtypes)
-
-                chunks = True if trait.array else False
-
-                compression_kwargs = {}
-                if chunks:
-                    if compression is not None:
-                        compression_kwargs['compression'] = compression
-                        if compression_opts is not None:
-                            compression_kwargs['compression_opts'] = compression_opts
-
-                dset = hfile.create_dataset('/{}'.format(name),
-                                            data=data,
-                                            chunks=chunks,
-                                            **compression_kwargs)
-
-                # Store the data type as an attribute to make it easier to
-                # reconstruct with correct data types
-                dset.attrs['type'] = str(type(data))
+                        data = _convert_string_fields(
+                            data, 'U', lambda values: np.char.encode(
+                                values, encoding), 'S')
+
+                chunks = None
+                if is_array:
+                    data = np.asanyarray(data)
+                    if not data.flags.c_contiguous:
+                        # Make the copy h5py would otherwise make internally
+                        # explicit
+                        logger.debug("Copying non-contiguous array %s to "
+                                     "write to HDF5", name)
+                        data = np.ascontiguousarray(data).view(type(data))
+                    if (pack and not data_is_recarray and
+                            data.dtype.kind in 'biufc'):
+                        packed.setdefault(data.dtype.name, []).append(
+                            (name, trait.desc, data))
+                        continue
+                    if soa and data_is_recarray:
+                        dset = hfile.create_group(paths[name])
+                        dset.attrs['fields'] = json.dumps(data.dtype.names)
+                        for field in data.dtype.names:
+                            column = np.ascontiguousarray(data[field])
+                            field_chunks = _auto_chunks(
+                                column.shape, column.dtype.itemsize,
+                                chunk_size)
+                            _create_dataset(
+                                dset, field, column, field_chunks,
+                                array_compression_kwargs if field_chunks
+                                else {}, pool, direct_chunk)
+                        if trait.desc is not None:
+                            dset.attrs['desc'] = trait.desc
+                        continue
+                    chunks = _auto_chunks(data.shape, data.dtype.itemsize,
+                                          chunk_size)
+
+                compression_kwargs = array_compression_kwargs if chunks else {}
+
+                dset = _create_dataset(hfile, paths[name], data,
+                                       chunks, compression_kwargs,
+                                       pool, direct_chunk)
 
                 if trait.desc is not None:
                     dset.attrs['desc'] = trait.desc
 
+            table = {}
+            for dtype_name, members in packed.items():
+                entries = []
+                offset = 0
+                for name, desc, data in members:
+                    entries.append({
+                        'name': name,
+                        'offset': offset,
+                        'shape': list(data.shape),
+                        'desc': desc,
+                    })
+                    offset += data.size
+
+                blob = np.concatenate([data.ravel() for _, _, data in members])
+                _create_dataset(hfile, '/packed_' + dtype_name, blob,
+                                _auto_chunks(blob.shape, blob.dtype.itemsize,
+                                             chunk_size),
+                                array_compression_kwargs, pool,
+                                direct_chunk)
+                table[dtype_name] = entries
+
+            if table:
+                hfile.attrs['packed'] = json.dumps(table)
+
+            if scalars:
+                hfile.attrs['scalars'] = json.dumps(scalars)
+
             hfile.attrs['classname'] = self.__class__.__name__
             hfile.attrs['python_module'] = self.__class__.__module__
 
@@ -273,7 +1441,7 @@ class Schema(HasTraits):
 
         Parameters
         ----------
-        filename : str
+        filename : str or file-like
         decode_string_arrays: bool
             Arrays of bytes should be decoded into strings
         encoding: str
@@ -288,54 +1456,94 @@ class Schema(HasTraits):
             raise OptionalDependencyMissingError("h5py not found")
 
         self = cls()
-        with h5py.File(filename, 'r') as hfile:
-            for name in self.visible_traits():
-                trait = self.trait(name)
-                if name not in hfile:
+        # Use a larger chunk cache than HDF5's 1 MiB default so that reading
+        # chunked datasets needs fewer lookups
+        with h5py.File(filename, 'r', rdcc_nbytes=64 * 1024 * 1024,
+                       rdcc_nslots=10007) as hfile:
+            # Arrays written with pack=True are views into a shared buffer
+            packed = {}
+            if 'packed' in hfile.attrs:
+                table = json.loads(hfile.attrs['packed'])
+                for dtype_name, entries in table.items():
+                    blob = hfile['/packed_' + dtype_name][()]
+                    for entry in entries:
+                        start = entry['offset']
+                        stop = start + int(np.prod(entry['shape']))
+                        packed[entry['name']] = \
+                            blob[start:stop].reshape(entry['shape'])
+
+            # Scalars written with scalars_as_attrs=True are root attributes
+            scalars = set()
+            if 'scalars' in hfile.attrs:
+                scalars.update(json.loads(hfile.attrs['scalars']))
+
+            paths = self._hdf_paths()
+            for name, is_array, dtype, _ in self._trait_plan():
+                if name in packed:
+                    setattr(self, name, packed[name])
+                    continue
+                if name in scalars:
+                    setattr(self, name, hfile.attrs[name])
+                    continue
+                # A single lookup instead of checking membership first
+                dset = hfile.get(paths[name])
+                if dset is None:
                     continue
-                dset = hfile['/{}'.format(name)]
-                data = dset.value
 
-                # Use type attribute to determine how to proceed
-                data_is_recarray = dset.attrs['type'] == str(np.recarray)
+                setattr(self, name, _read_hdf_dataset(
+                    dset, is_array, dtype, decode_string_arrays, encoding))
 
-                if trait.array is True and decode_string_arrays:
-                    # Encode each element of an array containing bytes
-                    if ~data_is_recarray and data.dtype.char == 'S':
-                        data = [s.decode(encoding) for s in data]
+        return self
 
-                    elif data_is_recarray:
-                        # Determine what the final dtypes will be
-                        final_dtypes = []
-                        bytes_fields = []
-                        for i, field in enumerate(data.dtype.names):
-                            if data[field].dtype.kind != 'S':
-                                final_dtypes.append((field,
-                                                     data[field].dtype.str))
-                            else:
-                                final_dtypes.append((field, '<U256'))
-                                bytes_fields.append(field)
-
-                        # Update dtypes of the data. This will coerce the
-                        # bytes fields to unicode automatically
-                        data = data.astype(final_dtypes)
-
-                setattr(self, name, data)
+    @classmethod
+    def from_hdf_lazy(cls, filename, decode_string_arrays=True,
+                      encoding='utf-8'):
+        """Open an HDF5 file written by :meth:`to_hdf` without reading any
+        datasets until the corresponding traits are accessed.
 
-        return self
+        Parameters are the same as for :meth:`from_hdf`.
+
+        Returns
+        -------
+        A proxy whose attributes are the traits of the class. Call its
+        ``load`` method to read everything else and get a regular instance.
 
-    # FIXME: this should optionally write to a file
-    def to_json(self, json_kwargs={}):
+        Notes
+        -----
+        This trades keeping the file open for not reading data which isn't
+        needed. Use the proxy as a context manager or call its ``close``
+        method to close the file.
+
+        """
+        if h5py is None:  # pragma: nocover
+            raise OptionalDependencyMissingError("h5py not found")
+        return _LazyHDFSchema(cls, filename, decode_string_arrays, encoding)
+
+    def to_json(self, json_kwargs={}, as_bytes=False, fp=None,
+                tag_arrays=False):
         """Serialize to JSON.
 
         Parameters
         ----------
         json_kwargs : dict
             Keyword arguments to pass to :func:`json.dumps`.
+        as_bytes : bool
+            Return UTF-8 encoded bytes instead of a string. This avoids an
+            extra decoding step when using :mod:`orjson` and writing to a file
+            opened in binary mode. Default: False.
+        fp : file-like or None
+            When given, write the JSON to this file object instead of returning
+            it. Files may be opened in either text or binary mode, but binary
+            mode avoids an extra encoding step with :mod:`orjson`.
+        tag_arrays : bool
+            Encode arrays as objects of the form ``{"__ndarray__": true,
+            "dtype": ..., "shape": [...], "data": [...]}`` with the data
+            flattened. :meth:`from_json` uses these to rebuild arrays with
+            their original dtype and shape in a single step. Default: False.
 
         Returns
         -------
-        JSON string.
+        JSON string or bytes, or None when writing to ``fp``.
 
         Notes
         -----
@@ -344,10 +1552,116 @@ class Schema(HasTraits):
         serializing in HDF5 format instead. As a consequence of using a custom
         encoder, the ``cls`` keyword arugment, if passed, will be ignored.
 
+        When :mod:`orjson` is installed and ``json_kwargs`` contains no options
+        other than ``indent=2`` or ``sort_keys``, it is used to serialize numpy
+        arrays directly without first converting them to lists. Otherwise,
+        :mod:`ujson` is used if installed. Anything these can't handle (e.g.,
+        recarrays) falls back to the standard library.
+
+        """
+        data = self.to_dict()
+
+        # Fail early instead of letting a faster backend try to encode
+        # everything before falling back to the standard library
+        for name, is_array, _, _ in self._trait_plan():
+            if is_array and isinstance(data[name], np.recarray):
+                raise RuntimeError(_RECARRAY_JSON_ERROR)
+
+        if tag_arrays:
+            data = {key: _tag_array(value) if isinstance(value, np.ndarray)
+                    else value for key, value in data.items()}
+
+        text_file = isinstance(fp, io.TextIOBase)
+        encoded = _dumps_json(data, json_kwargs, fp if text_file else None)
+
+        if fp is not None:
+            if encoded is not None:
+                _write_json(fp, encoded)
+            return None
+
+        if as_bytes:
+            if not isinstance(encoded, bytes):
+                encoded = encoded.encode('utf-8')
+        elif not isinstance(encoded, str):
+            encoded = encoded.decode('utf-8')
+        return encoded
+
+    def to_json_file(self, fp):
+        """Serialize to JSON, writing to a file object one trait at a time.
+
+        The output is the same JSON object produced by :meth:`to_json`, but
+        since each trait is encoded separately, memory use is bounded by the
+        largest trait rather than by the whole schema.
+
+        Parameters
+        ----------
+        fp : file-like
+            File object opened in text or binary mode to write to. Binary mode
+            avoids an extra encoding step with :mod:`orjson`.
+
+        """
+        data = self.to_dict()
+
+        # Fail before writing anything
+        for name, is_array, _, _ in self._trait_plan():
+            if is_array and isinstance(data[name], np.recarray):
+                raise RuntimeError(_RECARRAY_JSON_ERROR)
+
+        _write_json(fp, '{')
+        for i, (name, value) in enumerate(data.items()):
+            # Encode as a single member object and drop the braces
+            encoded = _dumps_json({name: value}, {})
+            if i > 0:
+                _write_json(fp, ', ')
+            _write_json(fp, encoded[1:-1])
+        _write_json(fp, '}')
+
+    def to_json_stream(self, fp):
+        """Serialize to newline-delimited JSON with one object per trait.
+
+        Each line has the form ``{"name": <trait name>, "value": <value>}``.
+        Since traits are encoded one at a time, memory use is bounded by the
+        largest trait rather than by the whole schema.
+
+        Parameters
+        ----------
+        fp : file-like
+            File object opened in text or binary mode to write to.
+
         """
-        data = {name: getattr(self, name) for name in self.visible_traits()}
-        json_kwargs['cls'] = _NumpyJsonEncoder
-        return json.dumps(data, **json_kwargs)
+        data = self.to_dict()
+
+        # Fail before writing anything
+        for name, is_array, _, _ in self._trait_plan():
+            if is_array and isinstance(data[name], np.recarray):
+                raise RuntimeError(_RECARRAY_JSON_ERROR)
+
+        for name, value in data.items():
+            encoded = _dumps_json({'name': name, 'value': value}, {})
+            newline = b'\n' if isinstance(encoded, bytes) else '\n'
+            _write_json(fp, encoded + newline)
+
+    @classmethod
+    def from_json_stream(cls, fp):
+        """Deserialize newline-delimited JSON written by
+        :meth:`to_json_stream`.
+
+        Parameters
+        ----------
+        fp : file-like
+
+        Returns
+        -------
+        Deserialized instance
+
+        """
+        kwargs = {}
+        for line in fp:
+            if not line.strip():
+                continue
+            record = _loads_json(line)
+            kwargs[record['name']] = record['value']
+        return cls(**kwargs)
 
     # FIXME allow filenames
     @classmethod
@@ -356,16 +1670,22 @@ class Schema(HasTraits):
 
         Parameters
         ----------
-        data : str or file-like
+        data : str, bytes or file-like
 
         Returns
         -------
         Deserialized instance
 
-        """
-        if not isinstance(data, str):
-            loaded = json.load(data)
-        else:
-            loaded = json.loads(data)
+        Notes
+        -----
+        JSON arrays are converted to numpy arrays when assigned to ``Array``
+        traits. Declaring a ``dtype`` on these traits lets the decoded lists be
+        converted with a single call to :func:`numpy.asarray` instead of
+        first inferring a dtype and then casting. Arrays written with
+        ``to_json(tag_arrays=True)`` are always rebuilt with their stored
+        dtype and shape.
 
-        return cls(**{key: value for key, value in loaded.items()})
+        """
+        loaded = _loads_json(_read_json(data))
+        return cls(**{key: _untag_array(value)
+                      for key, value in loaded.items()})